@@ -1,28 +1,160 @@
 from picamera2 import Picamera2
-from flask import Flask, send_file, render_template
+from flask import Flask, Response, jsonify, render_template, request
+from collections import deque
 import io
 import logging
 import threading
 import time
 import os
 
+import numpy as np
+import simplejpeg
+from dotenv import load_dotenv
+
+from face_crops import FaceCropper
+from frame_ring import FrameRing
+
+load_dotenv(verbose=True, override=True)
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
 # Create Flask application
 app = Flask(__name__)
 
-# Image save path
-STATIC_FOLDER = 'static'
-IMAGE_PATH = os.path.join(STATIC_FOLDER, 'latest_image.jpg')
+# Capture rates (frames per second) picked by the demand-driven capture loop
+ACTIVE_FPS = float(os.getenv("ACTIVE_FPS", "5"))  # Someone is watching and the scene is moving
+STILL_FPS = float(os.getenv("STILL_FPS", "1"))  # Someone is watching, nothing is moving
+IDLE_FPS = float(os.getenv("IDLE_FPS", "0.2"))  # Nobody has asked for a frame recently
+
+SUBSCRIBER_TIMEOUT = 3.0  # Seconds without a request before a client no longer counts as watching
+MOTION_HOLD = 2.0  # Seconds to stay at ACTIVE_FPS after the last detected motion
+MOTION_THRESHOLD = float(os.getenv("MOTION_THRESHOLD", "6"))  # Mean abs luma difference
+FRESH_FRAME_AGE = 1.0  # Frames older than this are refreshed on request instead of served
+STATS_INTERVAL = 10  # Seconds between stats log lines
+
+LORES_SIZE = (320, 240)  # Cheap stream used for motion and face detection
+JPEG_QUALITY = 85
+USE_HARDWARE_ENCODER = int(os.getenv("HW_ENCODER", "1")) == 1
+EDGE_FACES = int(os.getenv("EDGE_FACES", "0")) == 1  # Detect faces on the Pi and serve crops
+# Shared-memory ring of raw frames for a recognizer on the same host, disabled when empty
+FRAME_RING = os.getenv("FRAME_RING", "")
+FRAME_RING_SLOTS = int(os.getenv("FRAME_RING_SLOTS", "4"))
+
+
+class FrameBuffer(io.BufferedIOBase):
+    """Holds the latest JPEG frame, who is asking for it and capture statistics"""
+
+    def __init__(self):
+        self.frame = None
+        self.timestamp = 0
+        self.faces = None  # Latest face crop payload when edge face cropping is enabled
+        self.condition = threading.Condition()
+        self.wakeup = threading.Event()
+        self.subscribers = {}  # client address -> time of last frame request
+        self.face_subscribers = {}  # client address -> time of last face crop request
+        self.frame_times = deque(maxlen=100)
+        self.frames_published = 0
+        self.encode_times = deque(maxlen=100)  # Software encoder only
+        self.encoder = "none"
+        self.target_fps = IDLE_FPS
+        self.cpu_percent = 0.0
+        # Process CPU time per published frame; the only cost measure for the hardware
+        # encoder, whose JPEG work happens off the CPU
+        self.cpu_ms_per_frame = None
+
+    def write(self, buf):
+        """Receive a frame from the hardware encoder output"""
+        self.publish(bytes(buf))
+        return len(buf)
+
+    def publish(self, jpeg, encode_time=None):
+        """Store a newly encoded frame and wake up any waiting requests"""
+        with self.condition:
+            self.frame = jpeg
+            self.timestamp = time.time()
+            self.frame_times.append(self.timestamp)
+            self.frames_published += 1
+            if encode_time is not None:
+                self.encode_times.append(encode_time)
+            self.condition.notify_all()
+
+    def publish_faces(self, payload):
+        """Store the face crops found in the latest frame and wake up any waiting requests"""
+        with self.condition:
+            self.faces = payload
+            self.condition.notify_all()
+
+    def request_faces(self, client):
+        """Register demand for face crops only and return reasonably fresh ones"""
+        with self.condition:
+            self.face_subscribers[client] = time.time()
+            if self.faces is not None and time.time() - self.faces["timestamp"] <= FRESH_FRAME_AGE:
+                return self.faces
+
+            # Stale or missing crops: wake the capture loop and wait briefly for new ones
+            self.wakeup.set()
+            self.condition.wait_for(
+                lambda: self.faces is not None
+                and time.time() - self.faces["timestamp"] <= FRESH_FRAME_AGE,
+                timeout=FRESH_FRAME_AGE,
+            )
+            return self.faces
+
+    def request_frame(self, client):
+        """Register demand from a client and return a reasonably fresh frame"""
+        with self.condition:
+            self.subscribers[client] = time.time()
+            if self.frame is not None and time.time() - self.timestamp <= FRESH_FRAME_AGE:
+                return self.frame
+
+            # Stale or missing frame: wake the capture loop and wait briefly for a new one
+            self.wakeup.set()
+            self.condition.wait(timeout=FRESH_FRAME_AGE)
+            return self.frame
+
+    def active_subscribers(self, now, faces=False):
+        """Return the number of clients that requested a frame (or face crops) recently"""
+        subscribers = self.face_subscribers if faces else self.subscribers
+        with self.condition:
+            for client, last_seen in list(subscribers.items()):
+                if now - last_seen > SUBSCRIBER_TIMEOUT:
+                    del subscribers[client]
+            return len(subscribers)
+
+    def stats(self):
+        """Effective capture rate and encode cost over the recent window
+
+        encode_ms is only measured for software encoding; compare cpu_ms_per_frame
+        between the two encoders to see the savings of the hardware one.
+        """
+        now = time.time()
+        recent = [t for t in self.frame_times if now - t <= 5]
+        effective_fps = (len(recent) - 1) / (recent[-1] - recent[0]) if len(recent) > 1 else 0.0
+        encode_ms = (
+            1000 * sum(self.encode_times) / len(self.encode_times) if self.encode_times else None
+        )
+        return {
+            "encoder": self.encoder,
+            "subscribers": self.active_subscribers(now),
+            "face_subscribers": self.active_subscribers(now, faces=True),
+            "target_fps": self.target_fps,
+            "effective_fps": round(effective_fps, 2),
+            "encode_ms": round(encode_ms, 2) if encode_ms is not None else None,
+            "cpu_percent": round(self.cpu_percent, 1),
+            "cpu_ms_per_frame": (
+                round(self.cpu_ms_per_frame, 2) if self.cpu_ms_per_frame is not None else None
+            ),
+        }
+
+
+frame_buffer = FrameBuffer()
 
-# Ensure static folder exists
-os.makedirs(STATIC_FOLDER, exist_ok=True)
 
 # Initialize camera
 def init_camera(resolution="low"):
     picam2 = Picamera2()
-    
+
     # Camera is OV5647, maximum resolution is 2592 x 1944
     resolutions = {
         "low": (640, 480),       # Prioritize smoothness
@@ -30,26 +162,174 @@ def init_camera(resolution="low"):
         "high": (1920, 1080),    # HD resolution
         "max": (2592, 1944)      # Maximum resolution (use with caution)
     }
-    
+
     selected_res = resolutions.get(resolution, resolutions["low"])
     logging.info(f"Starting camera, resolution set to: {selected_res[0]} x {selected_res[1]}")
-    
-    config = picam2.create_still_configuration(main={"size": selected_res})
+
+    # Main stream feeds the JPEG encoder, lores stream is only used for detection
+    config = picam2.create_video_configuration(
+        main={"size": selected_res, "format": "RGB888"},
+        lores={"size": LORES_SIZE, "format": "YUV420"},
+    )
     picam2.configure(config)
     picam2.start()
     return picam2
 
-# Thread function for periodic image capture
-def capture_images(picam2, interval=0.2):  # 0.2 second interval, approx 5 images per second
-    while True:
+
+def target_fps(subscribers, since_motion):
+    """Pick the capture rate from current demand and recent motion"""
+    if not subscribers:
+        return IDLE_FPS
+    if since_motion < MOTION_HOLD:
+        return ACTIVE_FPS
+    return STILL_FPS
+
+
+def start_hardware_encoder(picam2):
+    """Start the hardware MJPEG encoder, returning None when it is unavailable"""
+    try:
+        from picamera2.encoders import MJPEGEncoder
+        from picamera2.outputs import FileOutput
+
+        encoder = MJPEGEncoder()
+        picam2.start_encoder(encoder, FileOutput(frame_buffer))
+        frame_buffer.encoder = "hardware"
+        logging.info("Hardware MJPEG encoder started")
+        return encoder
+    except Exception as e:
+        logging.warning(f"Hardware JPEG encoder unavailable, using software encoding: {e}")
+        return None
+
+
+def encode_frame(picam2):
+    """Capture the main stream and JPEG-encode it in software"""
+    frame = picam2.capture_array("main")
+    start = time.perf_counter()
+    # RGB888 from picamera2 is stored in BGR byte order
+    jpeg = simplejpeg.encode_jpeg(frame, quality=JPEG_QUALITY, colorspace="BGR")
+    frame_buffer.encoder = "software"
+    frame_buffer.publish(jpeg, time.perf_counter() - start)
+
+
+def capture_faces(picam2, cropper, frame_id, subscribers):
+    """Detect faces on the lores stream and publish crops cut from the same main frame"""
+    captured = picam2.capture_request()
+    try:
+        luma = captured.make_array("lores")[: LORES_SIZE[1]]
+        if subscribers:
+            boxes = cropper.detect(luma)
+            # Only copy the full main frame when there is something to crop
+            frame = captured.make_array("main") if boxes else None
+            frame_buffer.publish_faces(cropper.crop(frame, boxes, frame_id, time.time()))
+    finally:
+        captured.release()
+    return luma
+
+
+# Thread function for demand-driven image capture
+def capture_images(picam2, stop_event):
+    hardware_available = USE_HARDWARE_ENCODER
+    encoder = None
+    sensor_fps = None
+    previous_luma = None
+    last_motion = 0
+    last_stats = time.time()
+    last_cpu = time.process_time()
+    last_frames = frame_buffer.frames_published
+    # Sensor frame rate of the configuration, restored when the hardware encoder stops
+    default_controls = picam2.camera_configuration().get("controls", {})
+    default_durations = default_controls.get("FrameDurationLimits")
+    frame_id = 0
+    cropper = None
+    main_size = picam2.camera_configuration()["main"]["size"]
+    if EDGE_FACES:
+        cropper = FaceCropper(LORES_SIZE, main_size)
+    ring = None
+    if FRAME_RING:
+        ring = FrameRing.create(FRAME_RING, (main_size[1], main_size[0], 3), FRAME_RING_SLOTS)
+
+    while not stop_event.is_set():
         try:
-            # Capture image directly to file
-            picam2.capture_file(IMAGE_PATH)
-            time.sleep(interval)
+            now = time.time()
+            subscribers = frame_buffer.active_subscribers(now)
+            face_subscribers = frame_buffer.active_subscribers(now, faces=True)
+            ring_active = ring is not None and ring.reader_active()
+
+            frame_id += 1
+            if cropper is not None:
+                luma = capture_faces(picam2, cropper, frame_id, face_subscribers)
+            else:
+                luma = picam2.capture_array("lores")[: LORES_SIZE[1]]
+
+            # Motion detection on the Y plane of the lores stream
+            luma = luma.astype(np.int16)
+            if previous_luma is not None:
+                if np.abs(luma - previous_luma).mean() > MOTION_THRESHOLD:
+                    last_motion = now
+            previous_luma = luma
+
+            fps = target_fps(subscribers or face_subscribers or ring_active, now - last_motion)
+            frame_buffer.target_fps = fps
+
+            if ring_active:
+                # Raw frames for local readers, no JPEG round trip
+                ring.write(picam2.capture_array("main"))
+
+            # Only full-frame requests need JPEG frames, crop and ring readers do not
+            if subscribers:
+                if encoder is None and hardware_available:
+                    encoder = start_hardware_encoder(picam2)
+                    hardware_available = encoder is not None
+
+                if encoder is not None:
+                    # The hardware encoder runs at sensor rate, so throttle the sensor instead
+                    if fps != sensor_fps:
+                        picam2.set_controls({"FrameRate": max(fps, 1.0)})
+                        sensor_fps = fps
+                else:
+                    encode_frame(picam2)
+            elif encoder is not None:
+                # Nobody is watching: stop encoding entirely
+                picam2.stop_encoder()
+                encoder = None
+                if sensor_fps is not None and default_durations:
+                    # Do not leave the sensor throttled to the encoder's last rate
+                    picam2.set_controls({"FrameDurationLimits": default_durations})
+                sensor_fps = None
+                frame_buffer.encoder = "none"
+                logging.info("No subscribers, encoder stopped")
+
+            if now - last_stats >= STATS_INTERVAL:
+                cpu = time.process_time()
+                frames = frame_buffer.frames_published
+                frame_buffer.cpu_percent = 100 * (cpu - last_cpu) / (now - last_stats)
+                if frames > last_frames:
+                    frame_buffer.cpu_ms_per_frame = 1000 * (cpu - last_cpu) / (frames - last_frames)
+                last_cpu, last_stats, last_frames = cpu, now, frames
+                logging.info(f"Capture stats: {frame_buffer.stats()}")
+
+            # Sleep until the next frame is due or a request asks for a fresh frame
+            frame_buffer.wakeup.wait(1 / fps)
+            frame_buffer.wakeup.clear()
         except Exception as e:
             logging.error(f"Error capturing image: {e}")
             time.sleep(1)  # Wait longer before retrying on error
 
+    if encoder is not None:
+        picam2.stop_encoder()
+    if ring is not None:
+        # Readers re-attach to the ring recreated with the new resolution
+        ring.close()
+
+
+def start_capture_thread(picam2):
+    """Start the capture thread and return it with its stop event"""
+    stop_event = threading.Event()
+    thread = threading.Thread(target=capture_images, args=(picam2, stop_event), daemon=True)
+    thread.start()
+    return thread, stop_event
+
+
 # Route setup
 @app.route('/')
 def index():
@@ -57,47 +337,69 @@ def index():
     timestamp = int(time.time())
     return render_template('index.html', timestamp=timestamp)
 
+@app.route('/static/latest_image.jpg')
+def latest_image():
+    # Serving a frame counts as demand for the capture loop
+    frame = frame_buffer.request_frame(request.remote_addr)
+    if frame is None:
+        return "No frame available yet", 503
+    return Response(frame, mimetype='image/jpeg', headers={'Cache-Control': 'no-store'})
+
+@app.route('/faces')
+def faces():
+    # Compact alternative to the full frame: face crops with boxes and frame metadata
+    payload = frame_buffer.request_faces(request.remote_addr)
+    if payload is None:
+        return "Edge face cropping is not running", 503
+    return jsonify(payload)
+
+@app.route('/stats')
+def stats():
+    return jsonify(frame_buffer.stats())
+
 @app.route('/change_resolution/<resolution>')
 def change_resolution(resolution):
-    global picam2, capture_thread, current_resolution
-    
+    global picam2, capture_thread, capture_stop, current_resolution
+
     if resolution in ["low", "medium", "high", "max"]:
         current_resolution = resolution
-        
+
+        # Stop the capture thread before releasing the camera it uses
+        if capture_thread and capture_thread.is_alive():
+            capture_stop.set()
+            frame_buffer.wakeup.set()
+            capture_thread.join(timeout=5)
+
         # Stop current camera
         if picam2:
             picam2.close()
-        
+
         # Reinitialize camera
         picam2 = init_camera(resolution)
-        
-        # Restart capture thread
-        if capture_thread and capture_thread.is_alive():
-            # Cannot directly stop thread, but a new thread will start
-            pass
-        
-        capture_thread = threading.Thread(target=capture_images, args=(picam2,), daemon=True)
-        capture_thread.start()
-        
+
+        capture_thread, capture_stop = start_capture_thread(picam2)
+
     return render_template('redirect.html')
 
 # Set global variables
 current_resolution = "low"
 picam2 = None
 capture_thread = None
+capture_stop = None
 
 if __name__ == '__main__':
     # Initialize camera
     picam2 = init_camera(current_resolution)
-    
+
     # Start image capture thread
-    capture_thread = threading.Thread(target=capture_images, args=(picam2,), daemon=True)
-    capture_thread.start()
-    
+    capture_thread, capture_stop = start_capture_thread(picam2)
+
     try:
         # Run Flask application in a separate thread
         app.run(host='0.0.0.0', port=8000, threaded=True)
     finally:
         # Ensure camera stops on exit
+        if capture_stop:
+            capture_stop.set()
         if picam2:
             picam2.close()
@@ -0,0 +1,77 @@
+import base64
+import logging
+import os
+
+import cv2
+import simplejpeg
+
+# Configure logging
+logger = logging.getLogger("Face_Crops")
+
+# Haar cascade is cheap enough to run on the lores stream of a Pi
+if hasattr(cv2, "data"):
+    CASCADE_DIR = cv2.data.haarcascades
+else:
+    # Distribution builds of OpenCV (python3-opencv) do not ship cv2.data
+    CASCADE_DIR = "/usr/share/opencv4/haarcascades"
+DEFAULT_CASCADE = os.path.join(CASCADE_DIR, "haarcascade_frontalface_default.xml")
+
+
+class FaceCropper:
+    def __init__(self, lores_size, main_size, margin=0.25, min_face=24, quality=90):
+        """Initialize the face cropper for a lores detection stream and a main crop stream"""
+        cascade_path = os.getenv("FACE_CASCADE", DEFAULT_CASCADE)
+        self.detector = cv2.CascadeClassifier(cascade_path)
+        if self.detector.empty():
+            raise RuntimeError(f"Could not load face cascade from {cascade_path}")
+
+        self.lores_size = lores_size
+        self.main_size = main_size
+        self.margin = margin  # Extra context around each face, as a fraction of its size
+        self.min_face = min_face  # Minimum face size in lores pixels
+        self.quality = quality
+        logger.info(f"Face cropper initialized, lores {lores_size} -> main {main_size}")
+
+    def detect(self, luma):
+        """Detect faces on the lores luma plane, returning boxes in lores pixels"""
+        faces = self.detector.detectMultiScale(
+            luma, scaleFactor=1.1, minNeighbors=5, minSize=(self.min_face, self.min_face)
+        )
+        return [tuple(int(v) for v in face) for face in faces]
+
+    def to_main(self, box):
+        """Scale a lores box to main stream pixels, adding the context margin"""
+        sx = self.main_size[0] / self.lores_size[0]
+        sy = self.main_size[1] / self.lores_size[1]
+        x, y, w, h = box
+        pad_x, pad_y = w * self.margin, h * self.margin
+        left = max(0, int((x - pad_x) * sx))
+        top = max(0, int((y - pad_y) * sy))
+        right = min(self.main_size[0], int((x + w + pad_x) * sx))
+        bottom = min(self.main_size[1], int((y + h + pad_y) * sy))
+        return left, top, right - left, bottom - top
+
+    def crop(self, frame, boxes, frame_id, timestamp):
+        """Cut JPEG crops out of the main frame for the given lores boxes
+
+        Crops are padded by the margin but not aligned: the recognizer still has to
+        locate the landmarks and align the face, only on a much smaller image.
+        """
+        faces = []
+        for box in boxes:
+            x, y, w, h = self.to_main(box)
+            if w <= 0 or h <= 0:
+                continue
+            # RGB888 from picamera2 is stored in BGR byte order
+            crop = frame[y : y + h, x : x + w]
+            jpeg = simplejpeg.encode_jpeg(crop, quality=self.quality, colorspace="BGR")
+            faces.append(
+                {"bbox": [x, y, w, h], "jpeg": base64.b64encode(jpeg).decode("ascii")}
+            )
+
+        return {
+            "frame_id": frame_id,
+            "timestamp": timestamp,
+            "frame_size": list(self.main_size),
+            "faces": faces,
+        }
@@ -0,0 +1,221 @@
+import logging
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+# Configure logging
+logger = logging.getLogger("Frame_Ring")
+
+MAGIC = 0x474E5246  # "FRNG"
+# magic, slots, height, width, channels, frames written, closed, last read ns, generation
+HEADER_WORDS = 9
+SLOT_WORDS = 4  # sequence (odd while writing), frame number, timestamp ns, unused
+READER_TIMEOUT = 3.0  # Seconds since the last read before readers no longer count as demand
+STALE_TIMEOUT = 2.0  # Seconds without a new frame before a reader checks for a recreated ring
+
+
+def ring_size(slots, height, width, channels):
+    return 8 * HEADER_WORDS + 8 * SLOT_WORDS * slots + slots * height * width * channels
+
+
+class RingFrame:
+    """A frame read from the ring: a zero-copy view plus what is needed to validate it"""
+
+    def __init__(self, image, ring, slot, sequence, number, timestamp):
+        self.image = image
+        self.ring = ring
+        self.slot = slot
+        self.sequence = sequence
+        self.number = number
+        self.timestamp = timestamp
+
+
+class FrameRing:
+    """Raw frames in a shared-memory ring buffer, for a writer and readers on one host
+
+    Each slot carries a sequence number that is odd while the writer is copying a
+    frame in, so readers can detect a frame that was overwritten under them.
+    """
+
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.owner = owner
+        self.header = np.ndarray(HEADER_WORDS, np.uint64, buffer=shm.buf)
+        if int(self.header[0]) != MAGIC:
+            raise ValueError(f"Shared memory {shm.name} is not a frame ring")
+        slots, height, width, channels = (int(v) for v in self.header[1:5])
+        self.shape = (height, width, channels)
+        self.slots = np.ndarray(
+            (slots, SLOT_WORDS), np.uint64, buffer=shm.buf, offset=8 * HEADER_WORDS
+        )
+        self.frames = np.ndarray(
+            (slots, height, width, channels),
+            np.uint8,
+            buffer=shm.buf,
+            offset=8 * HEADER_WORDS + 8 * SLOT_WORDS * slots,
+        )
+
+    @classmethod
+    def create(cls, name, shape, slots=4):
+        """Create a ring for frames of the given (height, width, channels) shape"""
+        height, width, channels = shape
+        size = ring_size(slots, height, width, channels)
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # Left behind by a writer that did not shut down cleanly
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+        header = np.ndarray(HEADER_WORDS, np.uint64, buffer=shm.buf)
+        header[:] = 0
+        header[1:5] = (slots, height, width, channels)
+        header[8] = time.time_ns()
+        header[0] = MAGIC
+        logger.info(f"Frame ring {name} created: {slots} slots of {width}x{height}x{channels}")
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        """Attach to an existing ring as a reader"""
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13 the resource tracker would unlink the writer's ring on exit
+            shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return cls(shm, owner=False)
+
+    @property
+    def closed(self):
+        return bool(self.header[6])
+
+    @property
+    def count(self):
+        return int(self.header[5])
+
+    @property
+    def generation(self):
+        """Creation time of the ring, tells a recreated ring apart from the one a reader mapped"""
+        return int(self.header[8])
+
+    def write(self, frame):
+        """Copy a frame into the next slot"""
+        count = int(self.header[5])
+        slot = count % len(self.slots)
+        sequence = int(self.slots[slot, 0])
+        self.slots[slot, 0] = sequence + 1  # Odd: slot is being written
+        np.copyto(self.frames[slot], frame.reshape(self.shape))
+        self.slots[slot, 1] = count
+        self.slots[slot, 2] = time.time_ns()
+        self.slots[slot, 0] = sequence + 2
+        self.header[5] = count + 1
+
+    def reader_active(self):
+        """True when a reader asked for a frame recently"""
+        return time.time_ns() - int(self.header[7]) < READER_TIMEOUT * 1e9
+
+    def latest(self, copy=False):
+        """Return the most recent frame as a RingFrame, or None if there is none yet
+
+        Without copy the image is a view into shared memory that stays valid until
+        the writer wraps around; check it with is_valid() after using it.
+        """
+        self.header[7] = time.time_ns()
+        for _ in range(3):
+            count = int(self.header[5])
+            if count == 0:
+                return None
+            slot = (count - 1) % len(self.slots)
+            sequence = int(self.slots[slot, 0])
+            if sequence % 2:
+                continue  # Being overwritten right now, retry with the newer count
+            frame = RingFrame(
+                self.frames[slot],
+                self,
+                slot,
+                sequence,
+                int(self.slots[slot, 1]),
+                int(self.slots[slot, 2]) / 1e9,
+            )
+            if copy:
+                frame.image = frame.image.copy()
+                if not self.is_valid(frame):
+                    continue
+            return frame
+        return None
+
+    def is_valid(self, frame):
+        """True if the frame's slot was not rewritten since the frame was read"""
+        if frame.ring is not self or self.slots is None:
+            return False
+        return int(self.slots[frame.slot, 0]) == frame.sequence
+
+    def close(self):
+        """Detach; the writer also marks the ring closed and removes it"""
+        if self.owner:
+            self.header[6] = 1
+        # Views must be released before the shared memory can be closed
+        self.header = self.slots = self.frames = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # A caller still holds a frame view, the mapping goes away with it
+            pass
+        if self.owner:
+            self.shm.unlink()
+
+
+class FrameRingReader:
+    """Reader that re-attaches when the writer recreates the ring
+
+    A writer that closes its ring (e.g. on a resolution change) marks it closed. One
+    that crashed never does, so a ring that stops advancing is compared with the ring
+    currently under the name and replaced when the generation differs.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.ring = None
+        self.last_count = None
+        self.last_progress = 0.0
+
+    def latest(self, copy=False):
+        if self.ring is not None and self.ring.closed:
+            self.ring.close()
+            self.ring = None
+        if self.ring is None:
+            try:
+                self.ring = FrameRing.attach(self.name)
+            except (FileNotFoundError, ValueError):
+                return None
+        else:
+            self.check_replaced()
+        return self.ring.latest(copy)
+
+    def check_replaced(self):
+        """Switch to a ring recreated under the same name after a writer crash"""
+        now = time.monotonic()
+        count = self.ring.count
+        if count != self.last_count:
+            self.last_count, self.last_progress = count, now
+            return
+        if now - self.last_progress < STALE_TIMEOUT:
+            return
+        self.last_progress = now  # Probe again only after another timeout
+        try:
+            current = FrameRing.attach(self.name)
+        except (FileNotFoundError, ValueError):
+            return
+        if current.generation == self.ring.generation:
+            current.close()
+            return
+        logger.info(f"Frame ring {self.name} was recreated, re-attaching")
+        self.ring.close()
+        self.ring = current
+
+    def is_valid(self, frame):
+        return frame.ring.is_valid(frame)
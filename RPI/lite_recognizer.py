@@ -0,0 +1,334 @@
+import argparse
+import gc
+import json
+import logging
+import os
+import resource
+import statistics
+import sys
+import time
+
+import cv2
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv(verbose=True, override=True)
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger("Lite_Recognizer")
+
+# Compact OpenCV Zoo models: YuNet detector (~0.3 MB) and SFace recognizer (~10 MB in int8)
+MODEL_DIR = os.getenv("LITE_MODEL_DIR", "models")
+DETECTOR_MODEL = os.path.join(MODEL_DIR, "face_detection_yunet_2023mar.onnx")
+RECOGNIZER_MODEL = os.path.join(MODEL_DIR, "face_recognition_sface_2021dec_int8.onnx")
+PICTURES_DIR = os.getenv("LITE_PICTURES_DIR", "pictures")
+GALLERY_PATH = os.getenv("LITE_GALLERY", "lite_gallery")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+# Memory budget: frames are skipped above LITE_RSS_LIMIT_MB and the process exits above 1.2x
+RSS_LIMIT_MB = float(os.getenv("LITE_RSS_LIMIT_MB", "200"))
+ADDRESS_LIMIT_MB = float(os.getenv("LITE_ADDRESS_LIMIT_MB", "0"))  # 0 disables RLIMIT_AS
+GALLERY_DTYPE = os.getenv("LITE_GALLERY_DTYPE", "int8")  # "int8" or "float16"
+MATCH_CHUNK = 1024  # Gallery rows dequantized at a time while matching
+
+COSINE_THRESHOLD = 0.363  # SFace similarity threshold recommended by OpenCV
+DETECTION_SIZE = (320, 240)  # Frames are downscaled to this size for detection
+RPI_HOST = os.getenv("LITE_CAMERA_HOST", "localhost")
+
+# MQTT Configuration, shared with mqtt_handler
+BROKER = os.getenv("BROKER")
+USERNAME = os.getenv("USERNAME")
+PASSWORD = os.getenv("PASSWORD")
+BROKER_AUTH = int(os.getenv("BROKER_AUTH", "1")) == 1
+TOPIC_PREFIX = os.getenv("TOPIC_PREFIX")
+
+
+def rss_mb():
+    """Current and peak resident set size of this process in MB"""
+    current = peak = 0
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                current = int(line.split()[1]) / 1024
+            elif line.startswith("VmHWM:"):
+                peak = int(line.split()[1]) / 1024
+    return current, peak
+
+
+def quantize(embeddings, dtype):
+    """Store normalized embeddings as int8 with a per-row scale, or as float16"""
+    if dtype == "float16":
+        return embeddings.astype(np.float16), np.ones(len(embeddings), np.float32)
+    scales = np.abs(embeddings).max(axis=1) / 127
+    scales[scales == 0] = 1
+    quantized = np.round(embeddings / scales[:, None]).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+class LiteRecognizer:
+    """Memory-budgeted face recognition that can run next to cam_capture on the Pi
+
+    The detector, recognizer and gallery are only loaded when first needed and the
+    gallery is memory-mapped in its quantized form.
+    """
+
+    def __init__(self):
+        self._detector = None
+        self._recognizer = None
+        self._gallery = None
+        self.memory = {"start": rss_mb()[0]}
+
+    @staticmethod
+    def require(path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(
+                f"{path} not found, download it from https://github.com/opencv/opencv_zoo"
+            )
+        return path
+
+    @property
+    def detector(self):
+        if self._detector is None:
+            self.require(DETECTOR_MODEL)
+            self._detector = cv2.FaceDetectorYN.create(DETECTOR_MODEL, "", DETECTION_SIZE, 0.8)
+            self.memory["detector"] = rss_mb()[0]
+        return self._detector
+
+    @property
+    def recognizer(self):
+        if self._recognizer is None:
+            self.require(RECOGNIZER_MODEL)
+            self._recognizer = cv2.FaceRecognizerSF.create(RECOGNIZER_MODEL, "")
+            self.memory["recognizer"] = rss_mb()[0]
+        return self._recognizer
+
+    @property
+    def gallery(self):
+        if self._gallery is None:
+            with open(GALLERY_PATH + ".json") as f:
+                identities = json.load(f)["identities"]
+            embeddings = np.load(GALLERY_PATH + ".npy", mmap_mode="r")
+            scales = np.load(GALLERY_PATH + ".scales.npy")
+            self._gallery = (identities, embeddings, scales)
+            self.memory["gallery"] = rss_mb()[0]
+        return self._gallery
+
+    def detect(self, frame):
+        """Detect faces on a downscaled copy, returning YuNet rows in frame coordinates"""
+        scale = min(DETECTION_SIZE[0] / frame.shape[1], DETECTION_SIZE[1] / frame.shape[0], 1)
+        small = cv2.resize(frame, None, fx=scale, fy=scale) if scale < 1 else frame
+        self.detector.setInputSize((small.shape[1], small.shape[0]))
+        _, faces = self.detector.detect(small)
+        if faces is None:
+            return []
+        # Box and landmark coordinates alternate x, y in the first 14 columns
+        faces[:, :14] /= scale
+        return list(faces)
+
+    def embed(self, frame, face):
+        aligned = self.recognizer.alignCrop(frame, face)
+        embedding = self.recognizer.feature(aligned).flatten()
+        return embedding / (np.linalg.norm(embedding) + 1e-10)
+
+    def match(self, embedding):
+        """Return (identity, similarity) of the best match, identity is None below threshold"""
+        identities, embeddings, scales = self.gallery
+        best, best_score = None, -1.0
+        # Dequantize in chunks so the gallery is never expanded to float32 as a whole
+        for start in range(0, len(identities), MATCH_CHUNK):
+            chunk = embeddings[start : start + MATCH_CHUNK].astype(np.float32)
+            scores = (chunk @ embedding) * scales[start : start + MATCH_CHUNK]
+            index = int(np.argmax(scores))
+            if scores[index] > best_score:
+                best, best_score = start + index, float(scores[index])
+        if best is None or best_score < COSINE_THRESHOLD:
+            return None, best_score
+        return identities[best], best_score
+
+    def recognize(self, frame):
+        """Return [(identity, similarity)] for every face in a BGR frame"""
+        return [self.match(self.embed(frame, face)) for face in self.detect(frame)]
+
+
+def enforce_memory_limit():
+    """Skip work when over budget, exit when collecting garbage does not help"""
+    current, _ = rss_mb()
+    if current <= RSS_LIMIT_MB:
+        return True
+    gc.collect()
+    current, _ = rss_mb()
+    if current > RSS_LIMIT_MB * 1.2:
+        logger.error(f"RSS {current:.0f} MB exceeds the {RSS_LIMIT_MB:.0f} MB ceiling, exiting")
+        sys.exit(1)
+    logger.warning(f"RSS {current:.0f} MB over budget, skipping frame")
+    return current <= RSS_LIMIT_MB
+
+
+def picture_identities(db_path):
+    """Yield (identity, path) for pictures/<identity>.jpg and pictures/<identity>/*.jpg"""
+    for name in sorted(os.listdir(db_path)):
+        path = os.path.join(db_path, name)
+        if os.path.isdir(path):
+            for picture in sorted(os.listdir(path)):
+                if picture.lower().endswith(IMAGE_EXTENSIONS):
+                    yield name, os.path.join(path, picture)
+        elif name.lower().endswith(IMAGE_EXTENSIONS):
+            yield os.path.splitext(name)[0], path
+
+
+def build_gallery(recognizer, db_path, dtype):
+    """Embed the pictures with SFace and save them quantized for memory-mapping"""
+    identities, embeddings = [], []
+    for identity, path in picture_identities(db_path):
+        frame = cv2.imread(path)
+        faces = recognizer.detect(frame) if frame is not None else []
+        if not faces:
+            logger.warning(f"No face found in {path}")
+            continue
+        # Keep the most confident face of each picture
+        face = max(faces, key=lambda row: row[14])
+        identities.append(identity)
+        embeddings.append(recognizer.embed(frame, face))
+
+    quantized, scales = quantize(np.array(embeddings, dtype=np.float32).reshape(-1, 128), dtype)
+    np.save(GALLERY_PATH + ".npy", quantized)
+    np.save(GALLERY_PATH + ".scales.npy", scales)
+    with open(GALLERY_PATH + ".json", "w") as f:
+        json.dump({"identities": identities, "dtype": dtype}, f)
+    logger.info(f"Saved {len(identities)} {dtype} embeddings to {GALLERY_PATH}.npy")
+
+
+def fetch_frame():
+    """Download and decode the latest frame from cam_capture"""
+    import requests
+
+    response = requests.get(f"http://{RPI_HOST}:8000/static/latest_image.jpg", timeout=5)
+    response.raise_for_status()
+    return cv2.imdecode(np.frombuffer(response.content, np.uint8), cv2.IMREAD_COLOR)
+
+
+class Feedback:
+    """Drives the LED and buzzer over MQTT and records check-ins, both loaded lazily"""
+
+    def __init__(self):
+        self.client = None
+        self.convex = None
+
+    def success(self, identity):
+        parts = identity.split("_")
+        if len(parts) != 2:
+            logger.warning(f"Identity format not recognized: {identity}")
+            return
+        email, full_name = parts[0], " ".join(parts[1].split("-"))
+        logger.info(f"Recognized person: {full_name} ({email})")
+
+        # Feedback is best effort: an outage must not stop the recognizer
+        if os.getenv("VITE_CONVEX_URL"):
+            try:
+                if self.convex is None:
+                    from convex import ConvexClient
+
+                    self.convex = ConvexClient(os.getenv("VITE_CONVEX_URL"))
+                self.convex.mutation(
+                    "checkins:create",
+                    {"email": email, "timestamp": time.time(), "name": full_name},
+                )
+            except Exception as e:
+                logger.error(f"Error recording check-in for {email}: {e}")
+
+        if BROKER:
+            try:
+                if self.client is None:
+                    import paho.mqtt.client as mqtt
+
+                    self.client = mqtt.Client()
+                    if BROKER_AUTH:
+                        self.client.username_pw_set(USERNAME, PASSWORD)
+                    # Connects (and reconnects) in the background instead of stalling a frame
+                    self.client.connect_async(BROKER, 1883, 60)
+                    self.client.loop_start()
+                # QoS 1 is held by paho until the connection is up, QoS 0 would be dropped
+                self.client.publish(TOPIC_PREFIX + "state", "SUCCESS", qos=1)
+            except Exception as e:
+                logger.error(f"Error sending feedback: {e}")
+
+
+def report(recognizer, latencies):
+    """Log memory per loaded component and recognition latency"""
+    current, peak = rss_mb()
+    stages = ", ".join(f"{stage} {mb:.0f} MB" for stage, mb in recognizer.memory.items())
+    logger.info(f"Memory: {stages}, now {current:.0f} MB, peak {peak:.0f} MB")
+    if latencies:
+        latencies = sorted(latencies)
+        logger.info(
+            f"Latency over {len(latencies)} frames: "
+            f"p50 {statistics.median(latencies) * 1000:.0f} ms, "
+            f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:.0f} ms, "
+            f"max {latencies[-1] * 1000:.0f} ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Low-memory face recognition for the 1GB Raspberry Pi. "
+        "To try the memory ceiling on any Linux box, run under "
+        "'systemd-run --user --scope -p MemoryMax=256M' or after 'ulimit -v'."
+    )
+    parser.add_argument("command", choices=["build", "run", "bench"])
+    parser.add_argument("--image", help="Benchmark on this image instead of the camera")
+    parser.add_argument("--frames", type=int, default=50, help="Frames to benchmark")
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds between frames")
+    args = parser.parse_args()
+
+    if ADDRESS_LIMIT_MB:
+        limit = int(ADDRESS_LIMIT_MB * 1024 * 1024)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    # A single OpenCV thread keeps per-thread buffers out of the budget
+    cv2.setNumThreads(1)
+
+    recognizer = LiteRecognizer()
+
+    if args.command == "build":
+        build_gallery(recognizer, PICTURES_DIR, GALLERY_DTYPE)
+        report(recognizer, [])
+        sys.exit(0)
+
+    feedback = Feedback()
+    latencies = []
+    try:
+        while args.command == "run" or len(latencies) < args.frames:
+            if not enforce_memory_limit():
+                time.sleep(args.interval)
+                continue
+            try:
+                frame = cv2.imread(args.image) if args.image else fetch_frame()
+            except Exception as e:
+                logger.error(f"Error fetching frame: {e}")
+                frame = None
+            if frame is None:
+                if args.image:
+                    logger.error(f"Could not read {args.image}")
+                    break
+                time.sleep(args.interval)
+                continue
+
+            start_time = time.perf_counter()
+            results = recognizer.recognize(frame)
+            latencies.append(time.perf_counter() - start_time)
+
+            if args.command == "run":
+                for identity, _ in results:
+                    if identity:
+                        feedback.success(identity)
+                # Only bench keeps every latency, a long run reports and starts over
+                if len(latencies) == 60:
+                    report(recognizer, latencies)
+                    latencies.clear()
+                time.sleep(args.interval)
+    except KeyboardInterrupt:
+        logger.info("Stopping lite recognizer")
+    finally:
+        report(recognizer, latencies)
@@ -0,0 +1,274 @@
+import argparse
+import logging
+import os
+import queue
+import random
+import resource
+import statistics
+import threading
+import time
+
+# Simulate the GPIO pins before any device controller is created
+from gpiozero import Device
+from gpiozero.pins.mock import MockFactory, MockPWMPin
+
+Device.pin_factory = MockFactory(pin_class=MockPWMPin)
+
+os.environ.setdefault("TOPIC_PREFIX", "loadtest/")
+import mqtt_handler
+import state_manager
+import buzzer_module
+import rgb_module
+from mqtt_handler import MQTTHandler
+from state_manager import StateManager
+
+# Command mix fired at the control stack: (weight, device, payload)
+COMMAND_MIX = [
+    (4, "state", "SUCCESS"),
+    (2, "state", "SCANNING"),
+    (1, "state", "ALREADY_SCANNED"),
+    (1, "state", "FAILURE"),
+    (2, "rgb", "color:1,0,1"),
+    (1, "buzzer", "beep:0.1"),
+]
+
+
+class ScaledTime:
+    """Stand-in for the time module that shortens every sleep by a constant factor"""
+
+    def __init__(self, scale):
+        self.scale = scale
+
+    def sleep(self, seconds):
+        time.sleep(seconds * self.scale)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class Message:
+    def __init__(self, topic, payload, seq):
+        self.topic = topic
+        self.payload = payload.encode()
+        self.seq = seq
+
+
+class InProcessBroker:
+    """Broker stand-in that delivers messages on one thread, like the paho network loop"""
+
+    def __init__(self):
+        self.messages = queue.Queue()
+        self.subscriptions = []
+        self.handler = None
+        self.thread = threading.Thread(target=self.deliver, daemon=True)
+
+    def subscribe(self, topic):
+        self.subscriptions.append(topic.rstrip("#"))
+
+    def attach(self, handler):
+        self.handler = handler
+        handler.on_connect(self, None, {}, 0)
+        self.thread.start()
+
+    def publish(self, topic, payload, seq):
+        self.messages.put(Message(topic, payload, seq))
+
+    def backlog(self):
+        return self.messages.qsize()
+
+    def deliver(self):
+        while True:
+            msg = self.messages.get()
+            if any(msg.topic.startswith(prefix) for prefix in self.subscriptions):
+                self.handler.on_message(self, None, msg)
+
+
+class LocalBroker:
+    """Publishes through a real MQTT broker, e.g. mosquitto on localhost"""
+
+    def __init__(self, host, port=1883):
+        import paho.mqtt.client as mqtt
+
+        self.host = host
+        self.client = mqtt.Client()
+        self.client.connect(host, port, 60)
+        self.client.loop_start()
+
+    def attach(self, handler):
+        mqtt_handler.BROKER = self.host
+        handler.start()
+        time.sleep(1)  # Give the handler time to subscribe
+
+    def publish(self, topic, payload, seq):
+        self.client.publish(topic, payload)
+
+    def backlog(self):
+        return None
+
+
+class Recorder:
+    """Wraps the control stack to timestamp every message and its first device effect"""
+
+    def __init__(self, handler):
+        self.lock = threading.Lock()
+        self.published = {}  # seq -> publish time
+        self.received = {}  # seq -> time on_message started
+        self.handled = {}  # seq -> time on_message returned
+        self.first_effect = {}  # seq -> time of the first LED or buzzer change
+        self.coalesced = 0
+        self.current = threading.local()
+        self.arrivals = 0
+
+        on_message = handler.on_message
+
+        def recorded_on_message(client, userdata, msg):
+            now = time.perf_counter()
+            with self.lock:
+                # Over a real broker messages arrive in publish order (QoS 0, one publisher)
+                seq = getattr(msg, "seq", self.arrivals)
+                self.arrivals += 1
+                self.received[seq] = now
+            self.current.seq = seq
+            try:
+                on_message(client, userdata, msg)
+            finally:
+                self.current.seq = None
+                self.handled[seq] = time.perf_counter()
+
+        # The paho client holds its own reference to the callback
+        handler.on_message = recorded_on_message
+        handler.client.on_message = recorded_on_message
+        self.wrap_effect(handler.rgb, "set_color")
+        self.wrap_effect(handler.buzzer.buzzer, "on")
+
+        transition_to = handler.state_manager.transition_to
+
+        def recorded_transition(new_state):
+            # Transitions to the state the system is already in are silently collapsed
+            if new_state == handler.state_manager.current_state:
+                with self.lock:
+                    self.coalesced += 1
+            transition_to(new_state)
+
+        handler.state_manager.transition_to = recorded_transition
+
+    def wrap_effect(self, target, name):
+        original = getattr(target, name)
+
+        def recorded(*args, **kwargs):
+            seq = getattr(self.current, "seq", None)
+            if seq is not None and seq not in self.first_effect:
+                self.first_effect[seq] = time.perf_counter()
+            return original(*args, **kwargs)
+
+        setattr(target, name, recorded)
+
+
+class ResourceSampler(threading.Thread):
+    """Samples thread count and broker backlog while the storm runs"""
+
+    def __init__(self, broker, interval=0.05):
+        super().__init__(daemon=True)
+        self.broker = broker
+        self.interval = interval
+        self.max_threads = threading.active_count()
+        self.max_backlog = 0
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.max_threads = max(self.max_threads, threading.active_count())
+            backlog = self.broker.backlog()
+            if backlog is not None:
+                self.max_backlog = max(self.max_backlog, backlog)
+
+
+def percentiles(values):
+    if not values:
+        return "n/a"
+    values = sorted(values)
+    p50 = statistics.median(values)
+    p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+    return f"p50 {p50 * 1000:.1f} ms, p95 {p95 * 1000:.1f} ms, max {values[-1] * 1000:.1f} ms"
+
+
+def run_storm(broker, recorder, count, rate, drain_timeout, time_scale=1.0):
+    """Publish count random commands at rate messages per second (0 = flat out)
+
+    time_scale is the factor the device sleeps were shortened by, reported with the latencies.
+    """
+    weights = [weight for weight, _, _ in COMMAND_MIX]
+    commands = random.choices(COMMAND_MIX, weights=weights, k=count)
+    prefix = mqtt_handler.TOPIC_PREFIX
+
+    sampler = ResourceSampler(broker)
+    sampler.start()
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+
+    for seq, (_, device, payload) in enumerate(commands):
+        recorder.published[seq] = time.perf_counter()
+        broker.publish(prefix + device, payload, seq)
+        if rate:
+            time.sleep(1 / rate)
+
+    # Wait for the control stack to work through the backlog
+    deadline = time.perf_counter() + drain_timeout
+    while len(recorder.handled) < count and time.perf_counter() < deadline:
+        time.sleep(0.05)
+
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    sampler.stop_event.set()
+
+    handled = [recorder.handled[s] - recorder.published[s] for s in recorder.handled]
+    effect = [recorder.first_effect[s] - recorder.published[s] for s in recorder.first_effect]
+    queued = [recorder.received[s] - recorder.published[s] for s in recorder.received]
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    print("\n--- Load Test Report ---")
+    print(f"Published: {count}, storm and drain took {wall:.2f} s")
+    print(f"Delivered: {len(recorder.received)}, handled: {len(recorder.handled)}")
+    print(f"Dropped (not handled within {drain_timeout} s): {count - len(recorder.handled)}")
+    print(f"Coalesced (state already active): {recorder.coalesced}")
+    if time_scale != 1:
+        # Only the LED and buzzer sleeps are scaled, so the latencies cannot simply be divided
+        print(f"Latencies below ran with device sleeps scaled by {time_scale:g}, not real device timing")
+    print(f"Queueing delay:     {percentiles(queued)}")
+    print(f"Publish to effect:  {percentiles(effect)}")
+    print(f"Publish to handled: {percentiles(handled)}")
+    if broker.backlog() is not None:
+        print(f"Max broker backlog: {sampler.max_backlog} messages")
+    print(f"Threads: max {sampler.max_threads}, now {threading.active_count()}")
+    print(f"CPU: {cpu:.2f} s ({100 * cpu / wall:.1f}% of one core), max RSS {usage.ru_maxrss} KB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fire MQTT command storms at the RPI control stack")
+    parser.add_argument("--messages", type=int, default=200, help="Number of commands to publish")
+    parser.add_argument("--rate", type=float, default=50, help="Messages per second, 0 for no pause")
+    parser.add_argument("--broker", help="Use a real MQTT broker at this host instead of the in-process one")
+    parser.add_argument("--time-scale", type=float, default=0.05, help="Factor applied to device sleeps")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="Seconds to wait for the backlog")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="Keep the control stack's INFO logging")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    # Shorten the LED and buzzer timings so long storms finish quickly
+    scaled = ScaledTime(args.time_scale)
+    for module in (state_manager, buzzer_module, rgb_module):
+        module.time = scaled
+
+    handler = MQTTHandler()
+    handler.state_manager = StateManager(handler)
+    recorder = Recorder(handler)
+    broker = LocalBroker(args.broker) if args.broker else InProcessBroker()
+    broker.attach(handler)
+
+    try:
+        run_storm(broker, recorder, args.messages, args.rate, args.drain_timeout, args.time_scale)
+    finally:
+        handler.cleanup()
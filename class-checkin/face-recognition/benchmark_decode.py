@@ -0,0 +1,86 @@
+import argparse
+import multiprocessing
+import statistics
+import time
+import cv2
+import numpy as np
+from fast_decode import crop_full_resolution, decode, turbo
+
+# Resolution presets of RPI/cam_capture.py
+PRESETS = {
+    "low": (640, 480),
+    "medium": (1280, 720),
+    "high": (1920, 1080),
+    "max": (2592, 1944),
+}
+# (label, decode scale, also crop a face region at full resolution)
+MODES = [
+    ("full decode", 1, False),
+    ("1/2 decode", 2, False),
+    ("1/4 decode", 4, False),
+    ("1/8 decode", 8, False),
+    ("1/4 + face crop", 4, True),
+]
+
+
+def make_jpeg(size, source=None):
+    """JPEG at a preset size, from a real picture if given, otherwise synthetic"""
+    width, height = size
+    if source:
+        img = cv2.resize(cv2.imread(source), size)
+    else:
+        # Smooth gradients plus noise compress roughly like a camera frame
+        x = np.linspace(0, 255, width, dtype=np.float32)
+        y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+        base = np.stack([x + 0 * y, y + 0 * x, (x + y) / 2], axis=2)
+        noise = np.random.default_rng(0).normal(0, 12, (height, width, 3))
+        img = np.clip(base + noise, 0, 255).astype(np.uint8)
+    return cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 85])[1].tobytes()
+
+
+def memory_kb(key):
+    """VmRSS / VmHWM of this process from /proc, in kB"""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(key + ":"):
+                return int(line.split()[1])
+
+
+def run_case(jpeg, size, scale, crop, repeats):
+    """Time one decode mode; runs in a fresh process so peak RSS is not shared"""
+    width, height = size
+    # A face-sized region in the middle of the frame
+    box = (width * 2 // 5, height // 3, width // 5, height // 3)
+    # Reset the peak so startup (imports, unpickling the JPEG) does not hide the decode
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    before = memory_kb("VmRSS")
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        decode(jpeg, scale)
+        if crop:
+            crop_full_resolution(jpeg, box)
+        times.append(time.perf_counter() - start)
+    peak = memory_kb("VmHWM")
+    return statistics.median(times) * 1000, (peak - before) / 1024
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare full and reduced-scale JPEG decoding at each camera preset"
+    )
+    parser.add_argument("--image", help="Picture to resize to each preset instead of a synthetic one")
+    parser.add_argument("--repeats", type=int, default=20, help="Decodes per measurement")
+    args = parser.parse_args()
+
+    print(f"Full-resolution face crops use {'PyTurboJPEG' if turbo else 'a full decode (PyTurboJPEG not installed)'}")
+    print(f"{'preset':<8} {'size':<11} {'mode':<17} {'decode ms':>10} {'peak MB':>9}")
+    context = multiprocessing.get_context("spawn")
+    for preset, size in PRESETS.items():
+        jpeg = make_jpeg(size, args.image)
+        resolution = f"{size[0]}x{size[1]}"
+        for label, scale, crop in MODES:
+            with context.Pool(1) as pool:
+                ms, peak = pool.apply(run_case, (jpeg, size, scale, crop, args.repeats))
+            print(f"{preset:<8} {resolution:<11} {label:<17} {ms:>10.2f} {peak:>9.1f}")
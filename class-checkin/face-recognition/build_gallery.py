@@ -0,0 +1,114 @@
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from embedding_cache import EmbeddingCache, content_hash
+from gallery import DETECTOR_BACKEND, MODEL_NAME, PICTURES_DIR, Gallery
+
+
+def init_worker():
+    """Load the model once per worker process, with one compute thread each"""
+    import tensorflow as tf
+    from deepface import DeepFace
+
+    # The pool provides the parallelism, so keep each process single-threaded
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    DeepFace.build_model(MODEL_NAME)
+
+
+def embed_task(path):
+    """Detect, align and embed one picture in a worker process"""
+    from gallery import embed_picture
+
+    try:
+        return path, embed_picture(path), None
+    except Exception as e:
+        return path, None, str(e)
+
+
+def build(db_path, workers, checkpoint_every):
+    gallery = Gallery(db_path)
+    cache = EmbeddingCache(MODEL_NAME, DETECTOR_BACKEND)
+    cached = cache.load()
+    signatures = gallery.scan()
+
+    # Resume: keep everything the cache already covers and only embed the rest
+    entries, todo = {}, []
+    for path, signature in signatures.items():
+        entry = cached.get(path)
+        if entry is not None and entry[0] == signature:
+            entries[path] = entry
+            continue
+        digest = content_hash(path)
+        found, embedding = cache.lookup(digest)
+        if found:
+            entries[path] = (signature, digest, embedding)
+        else:
+            todo.append((path, signature, digest))
+
+    print(f"{len(signatures)} pictures, {len(entries)} already cached, {len(todo)} to embed")
+    if not todo:
+        if set(cached) != set(entries):
+            cache.write(entries)  # Drop deleted pictures
+        return
+
+    pending = {path: (signature, digest) for path, signature, digest in todo}
+    done, failed = 0, 0
+    start_time = time.time()
+    # Spawn rather than fork, so workers do not inherit the parent's TensorFlow state
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=init_worker) as pool:
+        try:
+            futures = {pool.submit(embed_task, path) for path in pending}
+            while futures:
+                finished, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    path, embedding, error = future.result()
+                    if error:
+                        failed += 1
+                        print(f"Error embedding {path}: {error}")
+                        continue
+                    signature, digest = pending[path]
+                    entries[path] = (signature, digest, embedding)
+                    done += 1
+                    if done % checkpoint_every == 0:
+                        cache.write(entries)
+                        elapsed = time.time() - start_time
+                        rate = done / elapsed
+                        remaining = (len(todo) - done - failed) / rate
+                        print(
+                            f"Checkpoint: {done}/{len(todo)} embedded, "
+                            f"{rate:.2f} pictures/s, about {remaining:.0f} s left"
+                        )
+        except KeyboardInterrupt:
+            print("Interrupted, saving progress so the next run resumes here")
+            pool.shutdown(wait=False, cancel_futures=True)
+            cache.write(entries)
+            raise
+
+    cache.write(entries)
+    elapsed = time.time() - start_time
+    print(
+        f"Embedded {done} pictures in {elapsed:.1f} s with {workers} workers "
+        f"({done / elapsed:.2f} pictures/s), {failed} failed"
+    )
+    print(f"Gallery cache written to {cache.sidecar_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Embed the enrollment pictures in parallel into the recognizer's embedding cache"
+    )
+    parser.add_argument("--pictures", default=PICTURES_DIR, help="Gallery directory")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Worker processes")
+    parser.add_argument(
+        "--checkpoint-every", type=int, default=50, help="Pictures embedded between checkpoints"
+    )
+    args = parser.parse_args()
+
+    try:
+        build(args.pictures, args.workers, args.checkpoint_every)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,242 @@
+import argparse
+import os
+import time
+import numpy as np
+import deepface
+from deepface.modules import preprocessing
+from embedding_cache import PREPROCESSING_VERSION, ArrayStore, EmbeddingCache, content_hash
+from gallery import (
+    DETECTOR_BACKEND,
+    MODEL_NAME,
+    PICTURES_DIR,
+    Gallery,
+    detect_faces,
+    embed_faces,
+    identity_of,
+)
+
+STORE_DIR = os.getenv("CROP_STORE_DIR", ".crop_store")
+# Side of the stored square crops; 112 is ArcFace's input, larger models upsample from it
+CROP_SIZE = int(os.getenv("CROP_SIZE", "112"))
+EMBED_BATCH_SIZE = 256
+
+
+def pack_face(face, size=CROP_SIZE):
+    """Letterbox an aligned BGR uint8 face into a size x size crop, as the model preprocessing does"""
+    resized = preprocessing.resize_image(img=face.astype(np.float32) / 255, target_size=(size, size))
+    return np.rint(resized[0] * 255).astype(np.uint8)
+
+
+class CropStore(ArrayStore):
+    """Aligned gallery faces packed into one memory-mappable (N, size, size, 3) uint8 array
+
+    Decoding, detection and alignment run once per picture, so re-embedding the
+    gallery with another model only streams the crops. The sidecar is the identity
+    index: every picture with its stat signature, content hash, identity and row
+    (None when no face was found).
+    """
+
+    kind = "crop store"
+
+    def __init__(self, detector_backend=DETECTOR_BACKEND, size=CROP_SIZE, store_dir=STORE_DIR):
+        header = {
+            "detector": detector_backend,
+            "size": size,
+            "preprocessing": PREPROCESSING_VERSION,
+            "deepface": deepface.__version__,
+        }
+        super().__init__(store_dir, header, f"crops-{detector_backend}-{size}")
+        self.detector_backend = detector_backend
+        self.size = size
+        self.crops = np.zeros((0, size, size, 3), np.uint8)
+        self.entries = {}  # path -> {"signature", "hash", "identity", "row"}
+        self.index = []  # (path, identity) of every row
+
+    def load(self):
+        """Map the stored crops; returns False if there is no store for these settings yet"""
+        sidecar, crops = self.read()
+        if sidecar is None:
+            return False
+
+        self.crops = crops
+        self.entries = {item["path"]: item for item in sidecar["entries"]}
+        # Entries are stored in row order
+        self.index = [
+            (item["path"], item["identity"]) for item in sidecar["entries"] if item["row"] is not None
+        ]
+        return True
+
+    def labels(self):
+        """Identity of every row, aligned with the crops and their embeddings"""
+        return [identity for _, identity in self.index]
+
+    def detect(self, path):
+        """Packed crop of the most confident face in a picture, None if there is none"""
+        try:
+            faces = [face for face in detect_faces(path, self.detector_backend) if face[2]]
+        except Exception as e:
+            print(f"Error detecting faces in {path}: {e}")
+            return None
+        if not faces:
+            return None
+        face, _, _ = max(faces, key=lambda face: face[2])
+        return pack_face(face, self.size)
+
+    def build(self, db_path=PICTURES_DIR):
+        """Detect and pack every gallery picture the store does not cover yet"""
+        self.load()
+        signatures = Gallery(db_path).scan()
+
+        # Crops by content hash: rows of the current store first, new detections added below
+        crops = {}
+        for item in self.entries.values():
+            crops[item["hash"]] = self.crops[item["row"]] if item["row"] is not None else None
+        items, rows = [], []
+        detected = 0
+        start_time = time.time()
+        for path in sorted(signatures):
+            signature = signatures[path]
+            old = self.entries.get(path)
+            if old is not None and tuple(old["signature"]) == signature:
+                digest = old["hash"]
+            else:
+                digest = content_hash(path)
+            if digest not in crops:
+                crops[digest] = self.detect(path)
+                detected += 1
+                if detected % 50 == 0:
+                    rate = detected / (time.time() - start_time)
+                    print(f"Detected {detected} pictures, {rate:.2f} pictures/s")
+            crop = crops[digest]
+            row = None
+            if crop is not None:
+                row = len(rows)
+                rows.append(crop)
+            items.append(
+                {
+                    "path": path,
+                    "signature": list(signature),
+                    "hash": digest,
+                    "identity": identity_of(path, db_path),
+                    "row": row,
+                }
+            )
+
+        if len(items) == len(self.entries) and all(
+            self.entries.get(item["path"]) == item for item in items
+        ):
+            print(f"Crop store up to date: {len(rows)} faces from {len(items)} pictures")
+            return
+        self.write(items, rows)
+        print(
+            f"Packed {len(rows)} faces from {len(items)} pictures "
+            f"({detected} detected, {len(items) - len(rows)} without a face) into {self.array_name}"
+        )
+
+    def write(self, items, rows):
+        array_name, array_path = self.new_array()
+        if rows:
+            # Unchanged rows are copied straight from the previous mapping
+            packed = np.lib.format.open_memmap(
+                array_path, mode="w+", dtype=np.uint8, shape=(len(rows), self.size, self.size, 3)
+            )
+            for row, crop in enumerate(rows):
+                packed[row] = crop
+            packed.flush()
+            del packed
+        else:
+            np.save(array_path, np.zeros((0, self.size, self.size, 3), np.uint8))
+        self.commit(array_name, len(rows), items)
+        self.load()
+
+    def remove_array(self, name):
+        # Embeddings of the old array no longer line up with the rows, remove them with it
+        super().remove_array(name)
+        stem = os.path.splitext(name)[0]
+        for other in os.listdir(self.directory):
+            if other.startswith(stem + "-"):
+                os.remove(os.path.join(self.directory, other))
+
+    def embeddings_path(self, model_name):
+        return os.path.join(self.directory, f"{os.path.splitext(self.array_name)[0]}-{model_name}.npy")
+
+    def embed(self, model_name=MODEL_NAME, batch_size=EMBED_BATCH_SIZE, embed_batch=None):
+        """Embed every stored crop, streaming batches straight from the packed array
+
+        Returns normalized embeddings, memory-mapped from a file whose rows line up
+        with the crops. embed_batch(crops) -> embeddings replaces the DeepFace model,
+        e.g. to evaluate an ONNX export.
+        """
+        if embed_batch is None:
+            embed_batch = lambda crops: embed_faces(crops, model_name)
+        total = len(self.crops)
+        if total == 0:
+            return np.zeros((0, 0), np.float32)
+
+        path = self.embeddings_path(model_name)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        embeddings = None
+        start_time = time.time()
+        for start in range(0, total, batch_size):
+            batch = np.asarray(self.crops[start : start + batch_size])
+            result = np.asarray(embed_batch(batch), dtype=np.float32)
+            result /= np.linalg.norm(result, axis=1, keepdims=True) + 1e-10
+            if embeddings is None:
+                embeddings = np.lib.format.open_memmap(
+                    tmp_path, mode="w+", dtype=np.float32, shape=(total, result.shape[1])
+                )
+            embeddings[start : start + len(result)] = result
+            done = start + len(result)
+            print(f"Embedded {done}/{total} crops, {done / (time.time() - start_time):.1f} crops/s")
+        embeddings.flush()
+        del embeddings
+        os.replace(tmp_path, path)
+        return np.load(path, mmap_mode="r")
+
+    def to_cache(self, model_name, embeddings):
+        """Write the embeddings into the recognizer's EmbeddingCache for model_name"""
+        rows = {path: row for row, (path, _) in enumerate(self.index)}
+        entries = {
+            path: (
+                tuple(item["signature"]),
+                item["hash"],
+                embeddings[rows[path]] if path in rows else None,
+            )
+            for path, item in self.entries.items()
+        }
+        cache = EmbeddingCache(model_name, self.detector_backend)
+        # Loading first lets the write remove the array it replaces
+        cache.load()
+        cache.write(entries)
+        return cache.sidecar_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Pack aligned gallery faces once, then re-embed them with any model"
+    )
+    parser.add_argument("command", choices=["build", "embed"])
+    parser.add_argument("--pictures", default=PICTURES_DIR, help="Gallery directory")
+    parser.add_argument("--size", type=int, default=CROP_SIZE, help="Side of the stored crops")
+    parser.add_argument("--model", default=MODEL_NAME, help="DeepFace model to embed with")
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE, help="Crops per model call")
+    parser.add_argument(
+        "--cache", action="store_true", help="Also write the embeddings into the recognizer's cache"
+    )
+    args = parser.parse_args()
+
+    store = CropStore(size=args.size)
+    if args.command == "build":
+        store.build(args.pictures)
+    else:
+        if not store.load():
+            raise SystemExit(f"No crop store in {store.directory}, run 'python crop_store.py build' first")
+        start_time = time.time()
+        embeddings = store.embed(args.model, args.batch_size)
+        elapsed = time.time() - start_time
+        print(
+            f"Embedded {len(embeddings)} crops of {len(set(store.labels()))} students with "
+            f"{args.model} in {elapsed:.1f} s, saved to {store.embeddings_path(args.model)}"
+        )
+        if args.cache:
+            print(f"Gallery cache written to {store.to_cache(args.model, embeddings)}")
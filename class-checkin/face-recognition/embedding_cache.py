@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import uuid
+import numpy as np
+import deepface
+
+CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", ".embedding_cache")
+# Bump whenever the detection, alignment or normalization of pictures changes
+PREPROCESSING_VERSION = 1
+
+
+def content_hash(path):
+    """SHA-256 of the picture bytes, so renamed or copied files reuse their embedding"""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class ArrayStore:
+    """A memory-mappable .npy array indexed by a small JSON sidecar
+
+    The sidecar holds a header describing how the array was produced, so a store
+    written with other settings is ignored. Each write goes to a new array file and
+    the sidecar is swapped atomically, so processes still mapping the old array are
+    unaffected.
+    """
+
+    kind = "store"  # Named in warnings
+
+    def __init__(self, directory, header, prefix):
+        self.directory = directory
+        self.header = header
+        self.prefix = prefix
+        self.sidecar_path = os.path.join(directory, prefix + ".json")
+        self.array_name = None
+
+    def read_sidecar(self):
+        try:
+            with open(self.sidecar_path) as f:
+                sidecar = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            print(f"Ignoring corrupt {self.kind} {self.sidecar_path}: {e}")
+            return None
+        if sidecar.get("header") != self.header:
+            return None
+        return sidecar
+
+    def map_array(self, name, rows):
+        path = os.path.join(self.directory, name)
+        if not rows:
+            # Empty arrays cannot be memory-mapped
+            return np.load(path)
+        return np.load(path, mmap_mode="r")
+
+    def read(self):
+        """Return (sidecar, mapped array), or (None, None) when there is no usable store"""
+        # Another process may replace the array between reading the sidecar and mapping it
+        for _ in range(3):
+            sidecar = self.read_sidecar()
+            if sidecar is None:
+                return None, None
+            try:
+                array = self.map_array(sidecar["array"], sidecar["rows"])
+            except FileNotFoundError:
+                continue
+            self.array_name = sidecar["array"]
+            return sidecar, array
+        return None, None
+
+    def new_array(self):
+        """Return (name, path) of a fresh array file for the next write"""
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{self.prefix}-{uuid.uuid4().hex[:8]}.npy"
+        return name, os.path.join(self.directory, name)
+
+    def commit(self, array_name, rows, items):
+        """Point the sidecar at a newly written array, drop the old one and map the new one"""
+        sidecar = {"header": self.header, "array": array_name, "rows": rows, "entries": items}
+        tmp_path = f"{self.sidecar_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(sidecar, f)
+        os.replace(tmp_path, self.sidecar_path)
+
+        if self.array_name and self.array_name != array_name:
+            self.remove_array(self.array_name)
+        self.array_name = array_name
+        return self.map_array(array_name, rows)
+
+    def remove_array(self, name):
+        # Processes that already mapped the old array keep their pages after the unlink
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+
+class EmbeddingCache(ArrayStore):
+    """Content-addressed gallery embeddings stored as a memory-mappable .npy file
+
+    The sidecar lists every picture with its stat signature, the hash of its bytes
+    and its row in the array. Files are namespaced by model, detector, DeepFace
+    version and PREPROCESSING_VERSION, so changing any of them invalidates the cache.
+    """
+
+    kind = "embedding cache"
+
+    def __init__(self, model_name, detector_backend, cache_dir=CACHE_DIR):
+        header = {
+            "model": model_name,
+            "detector": detector_backend,
+            "preprocessing": PREPROCESSING_VERSION,
+            "deepface": deepface.__version__,
+        }
+        key = hashlib.sha1(json.dumps(header, sort_keys=True).encode()).hexdigest()[:12]
+        super().__init__(cache_dir, header, f"{model_name}-{detector_backend}-{key}")
+        self.identities = []
+        self.matrix = np.zeros((0, 0), np.float32)
+        self.by_hash = {}  # content hash -> embedding, None when the picture has no face
+
+    def load(self):
+        """Map the cached embeddings, returning {path: (signature, hash, embedding)}"""
+        sidecar, matrix = self.read()
+        if sidecar is None:
+            return {}
+
+        self.matrix = matrix
+        self.identities = []
+        entries = {}
+        for item in sidecar["entries"]:
+            embedding = None
+            if item["row"] is not None:
+                embedding = matrix[item["row"]]
+                self.identities.append(item["path"])
+            entries[item["path"]] = (tuple(item["signature"]), item["hash"], embedding)
+            self.by_hash[item["hash"]] = embedding
+        return entries
+
+    def arrays(self):
+        """Return (identities, memory-mapped embeddings) as last loaded or written"""
+        return self.identities, self.matrix
+
+    def lookup(self, digest):
+        """Return (found, embedding) for a content hash"""
+        return digest in self.by_hash, self.by_hash.get(digest)
+
+    def write(self, entries):
+        """Persist {path: (signature, hash, embedding)} and return (identities, embeddings)
+
+        The returned embeddings are memory-mapped from the new cache file.
+        """
+        identities, rows, items = [], [], []
+        for path in sorted(entries):
+            signature, digest, embedding = entries[path]
+            row = None
+            if embedding is not None:
+                row = len(rows)
+                rows.append(np.asarray(embedding, dtype=np.float32))
+                identities.append(path)
+            items.append(
+                {"path": path, "signature": list(signature), "hash": digest, "row": row}
+            )
+
+        array_name, array_path = self.new_array()
+        np.save(array_path, np.stack(rows) if rows else np.zeros((0, 0), np.float32))
+        self.matrix = self.commit(array_name, len(rows), items)
+        self.identities = identities
+        self.by_hash = {}
+        for item in items:
+            row = item["row"]
+            self.by_hash[item["hash"]] = self.matrix[row] if row is not None else None
+        return self.arrays()
@@ -0,0 +1,99 @@
+import io
+import cv2
+import numpy as np
+from PIL import Image
+
+# libjpeg can scale while decoding (in the DCT domain) by 1/2, 1/4 or 1/8
+REDUCED_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+FACE_MARGIN = 0.3  # Context kept around a face for full-resolution alignment
+
+try:
+    # Optional: lossless crops of the compressed image, so only the face region is decoded
+    from turbojpeg import TurboJPEG
+
+    turbo = TurboJPEG()
+except Exception:
+    turbo = None
+
+# MCU sizes per libjpeg-turbo subsampling (444, 422, 420, gray, 440, 411)
+MCU_WIDTH = [8, 16, 16, 8, 8, 32]
+MCU_HEIGHT = [8, 8, 16, 8, 16, 8]
+
+
+def decode(jpeg, scale=1):
+    """Decode a JPEG at 1/scale resolution without decoding it at full size first"""
+    return cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), REDUCED_FLAGS[scale])
+
+
+def jpeg_size(jpeg):
+    """(width, height) from the JPEG header, without decoding"""
+    return Image.open(io.BytesIO(jpeg)).size
+
+
+def crop_full_resolution(jpeg, box):
+    """Decode only the (x, y, w, h) region of a JPEG at full resolution
+
+    Returns (crop, (x, y)) where (x, y) is the crop's offset in the full image,
+    which can be slightly above and left of the requested box.
+    """
+    x, y, w, h = box
+    if turbo is not None:
+        width, height, subsample, _ = turbo.decode_header(jpeg)
+        # Lossless crops must start on an MCU boundary
+        mcu_w, mcu_h = MCU_WIDTH[subsample], MCU_HEIGHT[subsample]
+        left, top = x - x % mcu_w, y - y % mcu_h
+        right, bottom = min(width, x + w), min(height, y + h)
+        region = turbo.crop(jpeg, left, top, right - left, bottom - top)
+        return decode(region), (left, top)
+
+    # Without PyTurboJPEG the whole image has to be decoded before cropping
+    full = decode(jpeg)
+    return full[y : y + h, x : x + w].copy(), (x, y)
+
+
+def detect_faces_reduced(jpeg, scale):
+    """Detect on a 1/scale decode, then align each face from a full-resolution crop
+
+    Returns (aligned face, facial_area in full image pixels, confidence) like
+    gallery.detect_faces. Only saves time with PyTurboJPEG: without it the full
+    image still has to be decoded once a face is found.
+    """
+    # Imported here so the decode helpers can be benchmarked without loading DeepFace
+    from gallery import detect_faces, offset_area
+
+    width, height = jpeg_size(jpeg)
+    small = decode(jpeg, scale)
+    # Reduced decodes round up, so derive the exact factor from the result
+    factor_x, factor_y = width / small.shape[1], height / small.shape[0]
+
+    full = None  # Without PyTurboJPEG, decoded once for the first face and shared
+    faces = []
+    for _, area, confidence in detect_faces(small):
+        if not confidence:
+            continue
+        pad_w, pad_h = area["w"] * FACE_MARGIN, area["h"] * FACE_MARGIN
+        left = max(0, int((area["x"] - pad_w) * factor_x))
+        top = max(0, int((area["y"] - pad_h) * factor_y))
+        right = min(width, int((area["x"] + area["w"] + pad_w) * factor_x))
+        bottom = min(height, int((area["y"] + area["h"] + pad_h) * factor_y))
+
+        if turbo is not None:
+            crop, (offset_x, offset_y) = crop_full_resolution(
+                jpeg, (left, top, right - left, bottom - top)
+            )
+        else:
+            if full is None:
+                full = decode(jpeg)
+            crop, (offset_x, offset_y) = full[top:bottom, left:right], (left, top)
+        # Detecting again on the small full-resolution crop yields landmarks for alignment
+        detected = [face for face in detect_faces(crop) if face[2]]
+        if not detected:
+            continue
+        face, crop_area, crop_confidence = max(detected, key=lambda face: face[2])
+        faces.append((face, offset_area(crop_area, offset_x, offset_y), crop_confidence))
+    return faces
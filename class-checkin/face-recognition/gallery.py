@@ -0,0 +1,372 @@
+import os
+import threading
+import time
+import numpy as np
+import tensorflow as tf
+from deepface import DeepFace
+from deepface.modules import preprocessing, verification
+from embedding_cache import content_hash
+
+# Recognition settings shared by the gallery and the probe images
+MODEL_NAME = "ArcFace"
+DETECTOR_BACKEND = "mtcnn"
+DISTANCE_METRIC = "cosine"
+PICTURES_DIR = "pictures"
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+# Embeddings aggregated per student for the coarse matching pass
+PROTOTYPES_PER_IDENTITY = int(os.getenv("PROTOTYPES_PER_IDENTITY", "1"))
+# Students whose individual pictures are compared after the prototype pass
+REFINE_TOP_K = max(1, int(os.getenv("REFINE_TOP_K", "3")))  # At least the closest one
+# Seconds before an unchanged picture that failed to embed is tried again
+RETRY_FAILED_AFTER = float(os.getenv("RETRY_FAILED_AFTER", "600"))
+
+
+def normalize(embedding):
+    """L2-normalize an embedding so cosine distance becomes a dot product"""
+    embedding = np.asarray(embedding, dtype=np.float32)
+    return embedding / (np.linalg.norm(embedding) + 1e-10)
+
+
+def represent(img, detector_backend=DETECTOR_BACKEND):
+    """Return (embedding, facial_area, confidence) for every face found in img
+
+    Use detector_backend="skip" when img is already a face crop.
+    """
+    results = DeepFace.represent(
+        img_path=img,
+        model_name=MODEL_NAME,
+        detector_backend=detector_backend,
+        enforce_detection=False,
+    )
+    return [
+        (normalize(r["embedding"]), r["facial_area"], r.get("face_confidence", 0))
+        for r in results
+    ]
+
+
+def detect_faces(img, detector_backend=DETECTOR_BACKEND):
+    """Return (aligned BGR uint8 face, facial_area, confidence) for every face found in img
+
+    Detection is split from embedding so faces can be filtered before the costly part.
+    """
+    faces = DeepFace.extract_faces(
+        img_path=img,
+        detector_backend=detector_backend,
+        enforce_detection=False,
+        align=True,
+    )
+    return [
+        ((f["face"][:, :, ::-1] * 255).astype(np.uint8), f["facial_area"], f["confidence"])
+        for f in faces
+    ]
+
+
+def offset_area(facial_area, x, y):
+    """Move a facial_area (box and eye landmarks) found in a crop into the coordinates of the
+    image the crop was cut from at (x, y)"""
+    facial_area = dict(facial_area, x=facial_area["x"] + x, y=facial_area["y"] + y)
+    for eye in ("left_eye", "right_eye"):
+        if facial_area.get(eye):
+            facial_area[eye] = (facial_area[eye][0] + x, facial_area[eye][1] + y)
+    return facial_area
+
+
+def embed_faces(faces, model_name=MODEL_NAME):
+    """Embed a batch of aligned BGR uint8 face crops with a single model call
+
+    Mirrors the preprocessing DeepFace.represent applies with detector_backend="skip".
+    """
+    if len(faces) == 0:
+        return []
+    model = DeepFace.build_model(model_name)
+    height, width = model.input_shape[1], model.input_shape[0]
+    batch = np.concatenate(
+        [
+            preprocessing.resize_image(img=face.astype(np.float32) / 255, target_size=(height, width))
+            for face in faces
+        ]
+    )
+    batch = preprocessing.normalize_input(img=batch, normalization="base")
+
+    if isinstance(getattr(model, "model", None), tf.keras.Model):
+        embeddings = np.asarray(model.model(batch, training=False))
+    else:
+        # SFace and Dlib wrap non-Keras networks that only embed one face at a time
+        embeddings = np.array([np.asarray(model.forward(img[None])).reshape(-1) for img in batch])
+    return [normalize(embedding) for embedding in embeddings]
+
+
+def embed_picture(path):
+    """Embed the most confident face of an enrollment picture, None if there is none"""
+    faces = represent(path)
+    if not faces:
+        return None
+    embedding, _, _ = max(faces, key=lambda face: face[2])
+    return embedding
+
+
+def identity_of(path, db_path=PICTURES_DIR):
+    """Identity name of a picture: its subdirectory (pictures/zn23_Loya-Niu/1.jpg)
+    or, for pictures directly in the gallery directory, its filename (pictures/zn23_Loya-Niu.jpg)
+    """
+    parent = os.path.dirname(path)
+    if os.path.normpath(parent) != os.path.normpath(db_path):
+        return os.path.basename(parent)
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def build_prototypes(embeddings, count=PROTOTYPES_PER_IDENTITY):
+    """Aggregate the normalized embeddings of one identity into at most count prototypes"""
+    if count <= 1:
+        return normalize(embeddings.mean(axis=0))[None]
+    if len(embeddings) <= count:
+        return np.array(embeddings, dtype=np.float32)
+
+    # Spherical k-means, seeded with evenly spaced pictures
+    centers = np.array(embeddings[np.linspace(0, len(embeddings) - 1, count).astype(int)])
+    for _ in range(10):
+        assignment = np.argmax(embeddings @ centers.T, axis=1)
+        for k in range(count):
+            members = embeddings[assignment == k]
+            if len(members):
+                centers[k] = normalize(members.mean(axis=0))
+    return centers
+
+
+class GallerySnapshot:
+    """Immutable view of the gallery that in-flight matches can keep using
+
+    Matching compares the probe against a few prototypes per identity first and
+    then only against the individual pictures of the REFINE_TOP_K closest identities.
+    """
+
+    def __init__(self, identities, labels, embeddings, threshold):
+        self.identities = tuple(identities)  # Unique identity names
+        self.labels = np.asarray(labels, dtype=np.int64)  # Identity index of each picture row
+        self.embeddings = embeddings
+        self.embeddings.setflags(write=False)
+        self.threshold = threshold
+        # Picture rows of each identity
+        order = np.argsort(self.labels, kind="stable")
+        counts = np.bincount(self.labels, minlength=len(self.identities))
+        self.rows = np.split(order, np.cumsum(counts)[:-1]) if len(self.identities) else []
+
+        prototypes, prototype_labels = [], []
+        for i, rows in enumerate(self.rows):
+            centers = build_prototypes(np.asarray(self.embeddings[rows]))
+            prototypes.append(centers)
+            prototype_labels.extend([i] * len(centers))
+        self.prototypes = np.concatenate(prototypes) if prototypes else np.zeros((0, 0), np.float32)
+        self.prototype_labels = np.asarray(prototype_labels, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def match(self, embedding):
+        """Return (identity, distance) of the closest picture, identity is None above threshold"""
+        if not self.identities:
+            return None, None
+
+        # Coarse pass over the prototypes, keeping the closest prototype per identity
+        per_identity = np.full(len(self.identities), np.inf, dtype=np.float32)
+        np.minimum.at(per_identity, self.prototype_labels, 1 - self.prototypes @ embedding)
+        if len(per_identity) > REFINE_TOP_K:
+            candidates = np.argpartition(per_identity, REFINE_TOP_K - 1)[:REFINE_TOP_K]
+        else:
+            candidates = np.arange(len(per_identity))
+
+        # Refine against the individual pictures of the candidates only
+        rows = np.concatenate([self.rows[c] for c in candidates])
+        distances = 1 - self.embeddings[rows] @ embedding
+        best = int(np.argmin(distances))
+        distance = float(distances[best])
+        if distance > self.threshold:
+            return None, distance
+        return self.identities[self.labels[rows[best]]], distance
+
+
+class Gallery:
+    """Enrolled pictures kept in sync with the pictures directory
+
+    refresh() only embeds added or changed files and then swaps in a new
+    snapshot, so matches never wait for enrollment work. With a cache, the
+    embeddings are persisted and memory-mapped back, so a restart only has to
+    stat the pictures directory.
+    """
+
+    def __init__(self, db_path=PICTURES_DIR, cache=None):
+        self.db_path = db_path
+        self.cache = cache
+        self.threshold = verification.find_threshold(MODEL_NAME, DISTANCE_METRIC)
+        self.entries = {}  # path -> (file signature, content hash, embedding or None)
+        self.pending = {}  # path -> signature seen on the previous scan, still settling
+        self.failed = {}  # path -> (signature, retry time) of pictures that could not be embedded
+        self.snapshot = self.build_snapshot([], np.zeros((0, 0), np.float32))
+        self.refresh_lock = threading.Lock()
+
+    def scan(self, directory=None):
+        """Return {path: (mtime_ns, size)} for every picture in the gallery directory
+
+        Pictures may sit directly in the gallery directory (one per student) or in
+        one subdirectory per student holding several enrollment pictures.
+        """
+        signatures = {}
+        with os.scandir(directory or self.db_path) as entries:
+            for entry in entries:
+                if entry.is_dir() and directory is None:
+                    signatures.update(self.scan(entry.path))
+                elif entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    stat = entry.stat()
+                    signatures[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        return signatures
+
+    def load(self):
+        """Map cached embeddings and embed whatever the cache does not cover"""
+        if self.cache is not None:
+            self.entries = self.cache.load()
+            self.snapshot = self.build_snapshot(*self.cache.arrays())
+        self.refresh(settle=False)
+        print(
+            f"Loaded {len(self.snapshot)} gallery embeddings for "
+            f"{len(self.snapshot.identities)} students from {self.db_path}"
+        )
+        return self
+
+    def refresh(self, settle=True):
+        """Embed added or changed pictures, drop deleted ones and publish a new snapshot
+
+        With settle=True a new or changed file is only embedded once its size and
+        mtime are unchanged between two scans, so half-copied files are skipped.
+        Returns True when a new snapshot was published.
+        """
+        with self.refresh_lock:
+            signatures = self.scan()
+            removed = [path for path in self.entries if path not in signatures]
+            changed = []
+            for path, signature in signatures.items():
+                entry = self.entries.get(path)
+                if entry is not None and entry[0] == signature:
+                    continue
+                failure = self.failed.get(path)
+                if failure is not None and failure[0] == signature and time.time() < failure[1]:
+                    continue
+                if settle and self.pending.get(path) != signature:
+                    self.pending[path] = signature
+                    continue
+                changed.append(path)
+            self.pending = {
+                path: sig for path, sig in self.pending.items() if path in signatures
+            }
+            self.failed = {
+                path: failure for path, failure in self.failed.items() if path in signatures
+            }
+
+            if not removed and not changed:
+                return False
+
+            for path in removed:
+                del self.entries[path]
+                print(f"Removed from gallery: {path}")
+
+            updated = False
+            for path in changed:
+                self.pending.pop(path, None)
+                try:
+                    digest = content_hash(path)
+                except OSError as e:
+                    print(f"Error reading {path}: {e}")
+                    self.failed[path] = (signatures[path], time.time() + RETRY_FAILED_AFTER)
+                    continue
+                found, embedding = self.cache.lookup(digest) if self.cache else (False, None)
+                if not found:
+                    try:
+                        embedding = embed_picture(path)
+                    except Exception as e:
+                        # Retried when the file changes or after RETRY_FAILED_AFTER seconds
+                        print(f"Error embedding {path}: {e}")
+                        self.failed[path] = (signatures[path], time.time() + RETRY_FAILED_AFTER)
+                        continue
+                    if embedding is None:
+                        print(f"No face found, not added to gallery: {path}")
+                    else:
+                        print(f"Embedded into gallery: {path}")
+                # Remember files without a face too, so they are not re-embedded every scan
+                self.entries[path] = (signatures[path], digest, embedding)
+                self.failed.pop(path, None)
+                updated = True
+
+            if not removed and not updated:
+                # Every changed picture failed, the published snapshot is still current
+                return False
+            self.publish()
+            return True
+
+    def live_embeddings(self):
+        """Return (paths, embedding matrix) for pictures that contain a face"""
+        paths, embeddings = [], []
+        for path in sorted(self.entries):
+            embedding = self.entries[path][2]
+            if embedding is not None:
+                paths.append(path)
+                embeddings.append(embedding)
+        matrix = np.stack(embeddings) if embeddings else np.zeros((0, 0), np.float32)
+        return paths, matrix
+
+    def build_snapshot(self, paths, matrix):
+        """Group picture rows by identity and build an immutable snapshot"""
+        identities, labels, index = [], [], {}
+        for path in paths:
+            name = identity_of(path, self.db_path)
+            if name not in index:
+                index[name] = len(identities)
+                identities.append(name)
+            labels.append(index[name])
+        return GallerySnapshot(identities, labels, matrix, self.threshold)
+
+    def publish(self):
+        """Build a new immutable snapshot and swap it in"""
+        if self.cache is not None:
+            # Persist first and match against the memory-mapped copy
+            paths, matrix = self.cache.write(self.entries)
+        else:
+            paths, matrix = self.live_embeddings()
+        # Rebinding the attribute is atomic, readers holding the old snapshot are unaffected
+        self.snapshot = self.build_snapshot(paths, matrix)
+
+    def match(self, embedding):
+        """Match against the current snapshot"""
+        return self.snapshot.match(embedding)
+
+
+class GalleryWatcher(threading.Thread):
+    """Background thread that polls the pictures directory and refreshes the gallery
+
+    With an executor, each refresh runs on it instead, so it can share the thread
+    that owns the model with recognition work.
+    """
+
+    def __init__(self, gallery, interval=2.0, executor=None):
+        super().__init__(daemon=True)
+        self.gallery = gallery
+        self.interval = interval
+        self.executor = executor
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                start_time = time.time()
+                if self.executor is None:
+                    updated = self.gallery.refresh()
+                else:
+                    updated = self.executor.submit(self.gallery.refresh).result()
+                if updated:
+                    print(
+                        f"Gallery updated to {len(self.gallery.snapshot)} embeddings "
+                        f"in {time.time() - start_time:.2f} seconds"
+                    )
+            except Exception as e:
+                print(f"Error refreshing gallery: {e}")
+
+    def stop(self):
+        self.stop_event.set()
@@ -1,11 +1,57 @@
 import time
+import base64
 import requests
 import os
-from deepface import DeepFace
+import sys
+import cv2
+import numpy as np
+from dotenv import load_dotenv
+
+# Before the local imports, which read their settings at import time
+load_dotenv(verbose=True, override=True)
+
 from db import create_checkin
+from embedding_cache import EmbeddingCache
+from fast_decode import detect_faces_reduced, turbo
+from gallery import (
+    DETECTOR_BACKEND,
+    MODEL_NAME,
+    Gallery,
+    GalleryWatcher,
+    detect_faces,
+    embed_faces,
+    offset_area,
+)
+from quality import BurstSelector, QualityGate
 import state_controller
 
 RPI_HOST = os.getenv("RPI_HOST", "localhost")
+# "frame" downloads full frames, "crops" uses face crops detected on the Pi (EDGE_FACES=1),
+# "ring" reads raw frames from cam_capture's shared-memory ring on the same host
+FACE_SOURCE = os.getenv("FACE_SOURCE", "frame")
+FRAME_RING = os.getenv("FRAME_RING", "classcheckin")
+# FACE_SOURCE="ring" imports frame_ring.py from the Pi code instead of keeping a copy that
+# could drift from the writer's layout; by default it is found at RPI/ of this repository
+RPI_DIR = os.getenv(
+    "RPI_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "RPI")
+)
+# Detect on a 1/2, 1/4 or 1/8 scale decode of downloaded frames (1 decodes at full size)
+DETECTION_SCALE = int(os.getenv("DETECTION_SCALE", "1"))
+if DETECTION_SCALE > 1 and turbo is None:
+    # Without lossless crops the full image is decoded anyway, so the reduced decode is extra work
+    print("DETECTION_SCALE needs PyTurboJPEG (pip install PyTurboJPEG), decoding at full size")
+    DETECTION_SCALE = 1
+# Seconds between scans of the pictures directory for new, changed or deleted enrollments
+GALLERY_POLL_INTERVAL = float(os.getenv("GALLERY_POLL_INTERVAL", "2"))
+# Frames collected per recognition cycle; only the best crop of each person is embedded
+BURST_FRAMES = int(os.getenv("BURST_FRAMES", "3"))
+BURST_INTERVAL = float(os.getenv("BURST_INTERVAL", "0.2"))
+
+gallery = None
+last_frame_id = None
+frame_ring = None
+quality_gate = QualityGate()
+embedded_faces = 0
 
 
 def download_latest_image():
@@ -28,26 +74,117 @@ def download_latest_image():
         return None
 
 
-def recognize_face(image_path):
+def download_face_crops():
+    global last_frame_id
+    url = f"http://{RPI_HOST}:8000/faces"
+
     try:
-        # Use DeepFace.find function for face recognition
-        result = DeepFace.find(
-            img_path=image_path,
-            db_path="pictures",
-            model_name="ArcFace",
-            distance_metric="cosine",
-            enforce_detection=False,
-            detector_backend="mtcnn",
-        )
+        response = requests.get(url)
+        response.raise_for_status()
+        payload = response.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"Error downloading face crops: {e}")
+        return None
+
+    # Skip frames that were already processed
+    if payload["frame_id"] == last_frame_id:
+        return []
+    last_frame_id = payload["frame_id"]
+
+    # (crop, (x, y) of the crop in the full frame)
+    crops = []
+    for face in payload["faces"]:
+        data = np.frombuffer(base64.b64decode(face["jpeg"]), dtype=np.uint8)
+        x, y, _, _ = face["bbox"]
+        crops.append((cv2.imdecode(data, cv2.IMREAD_COLOR), (x, y)))
+    return crops
+
+
+def align_face_crops():
+    """Detect and align the face in each crop from the Pi
+
+    The Pi only cuts padded boxes; detecting on these small crops is cheap and yields
+    the aligned face and eye landmarks that a full frame would.
+    """
+    faces = []
+    for crop, (x, y) in download_face_crops() or []:
+        try:
+            detected = [face for face in detect_faces(crop) if face[2]]
+        except Exception as e:
+            print(f"Error during face detection: {e}")
+            continue
+        if detected:
+            face, facial_area, confidence = max(detected, key=lambda face: face[2])
+            faces.append((face, offset_area(facial_area, x, y), confidence))
+    return faces
+
+
+def read_ring_faces():
+    global frame_ring, last_frame_id
+    if frame_ring is None:
+        if not os.path.isfile(os.path.join(RPI_DIR, "frame_ring.py")):
+            raise SystemExit(f"FACE_SOURCE=ring needs frame_ring.py, not found in RPI_DIR={RPI_DIR}")
+        sys.path.append(RPI_DIR)
+        from frame_ring import FrameRingReader
+
+        frame_ring = FrameRingReader(FRAME_RING)
+
+    frame = frame_ring.latest()
+    if frame is None or frame.number == last_frame_id:
+        return []
+    last_frame_id = frame.number
+
+    # Detect straight on the shared-memory view, crops are copied out by the detector
+    try:
+        faces = detect_faces(frame.image)
+    except Exception as e:
+        print(f"Error during face detection: {e}")
+        return []
+    if not frame_ring.is_valid(frame):
+        print("Frame was overwritten during detection, skipping")
+        return []
+    return faces
+
+
+def capture_faces():
+    """Return (face, facial_area, confidence) for the faces in the latest frame"""
+    if FACE_SOURCE == "crops":
+        return align_face_crops()
+    if FACE_SOURCE == "ring":
+        return read_ring_faces()
+
+    image_path = download_latest_image()
+    if not image_path:
+        return []
+    try:
+        if DETECTION_SCALE > 1:
+            with open(image_path, "rb") as f:
+                return detect_faces_reduced(f.read(), DETECTION_SCALE)
+        return detect_faces(image_path)
+    except Exception as e:
+        print(f"Error during face detection: {e}")
+        return []
+
+
+def get_gallery():
+    global gallery
+    if gallery is None:
+        # Cached embeddings are memory-mapped, so startup does not re-embed the gallery
+        gallery = Gallery(cache=EmbeddingCache(MODEL_NAME, DETECTOR_BACKEND)).load()
+        # Pick up enrollments while running without rebuilding the whole gallery
+        GalleryWatcher(gallery, GALLERY_POLL_INTERVAL).start()
+    return gallery
 
-        print(result)
+
+def recognize_face(embedding):
+    try:
+        best_identity, best_distance = get_gallery().match(embedding)
 
         # If matching faces are found
-        if not result[0].empty:
-            # Get the best match
-            best_match = result[0].iloc[0]
-            # Extract filename from the path
-            filename = os.path.splitext(os.path.basename(best_match["identity"]))[0]
+        if best_identity:
+            print(f"Best match: {best_identity} (distance {best_distance:.3f})")
+            # Identity is the picture filename or the student's subdirectory name
+            filename = best_identity
 
             # Parse email and name from filename (format: zn23_Loya-Niu)
             parts = filename.split("_")
@@ -77,16 +214,70 @@ def recognize_face(image_path):
 
 
 def main():
-    # Download the latest image
-    image_path = download_latest_image()
-    if image_path:
-        # Recognize face
-        recognized_person = recognize_face(image_path)
-        return recognized_person
-    return None
+    global embedded_faces
+
+    # Collect a short burst and keep only the best-scoring crop of each person
+    selector = BurstSelector(quality_gate)
+    for i in range(BURST_FRAMES):
+        for face, facial_area, confidence in capture_faces():
+            selector.add(face, facial_area, confidence)
+        if i < BURST_FRAMES - 1:
+            time.sleep(BURST_INTERVAL)
+
+    faces = selector.best()
+    embedded_faces += len(faces)
+    print(
+        f"Quality gate: rejected {dict(quality_gate.rejections)}, "
+        f"{quality_gate.pose_unchecked} accepted without landmarks for a pose check, "
+        f"{selector.candidates - len(faces)} crops skipped by best-frame selection, "
+        f"{embedded_faces} embedded in total"
+    )
+
+    # Every source hands over BGR faces that detect_faces already aligned; embed_faces
+    # preprocesses them exactly like the gallery pictures, in one batch
+    try:
+        embeddings = embed_faces(faces)
+    except Exception as e:
+        print(f"Error during face recognition: {e}")
+        return None
+
+    recognized = []
+    for embedding in embeddings:
+        recognized_person = recognize_face(embedding)
+        if recognized_person:
+            recognized.append(recognized_person)
+    return recognized or None
+
+
+def check_self_match(max_distance=0.05):
+    """Run one gallery picture through the live detection and embedding path
+
+    It must match its own gallery entry at a distance close to 0; anything else means
+    probes and gallery are preprocessed differently (e.g. a swapped channel order).
+    """
+    paths = [path for path, entry in get_gallery().entries.items() if entry[2] is not None]
+    if not paths:
+        return True
+    path = paths[0]
+    faces = [face for face in detect_faces(path) if face[2]]
+    if not faces:
+        return True
+    face, _, _ = max(faces, key=lambda face: face[2])
+    identity, distance = get_gallery().match(embed_faces([face])[0])
+    if distance is None or distance > max_distance:
+        print(
+            f"WARNING: {path} matches its own gallery entry at distance {distance}, "
+            f"gallery and probe preprocessing differ"
+        )
+        return False
+    print(f"Self-match check passed: {path} at distance {distance:.4f}")
+    return True
 
 
 if __name__ == "__main__":
+    # Connect in the background while the models load
+    state_controller.initialize(timeout=0)
+    check_self_match()
     try:
         while True:
             print("Starting recognition")
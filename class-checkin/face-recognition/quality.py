@@ -0,0 +1,126 @@
+import math
+import os
+from collections import Counter
+import cv2
+
+# Faces failing any of these checks are not worth embedding
+MIN_FACE_SIZE = int(os.getenv("MIN_FACE_SIZE", "60"))  # Shorter side of the face box, pixels
+MIN_SHARPNESS = float(os.getenv("MIN_SHARPNESS", "50"))  # Variance of the Laplacian
+MAX_ROLL = 25  # Degrees of head tilt, from the eye line
+MAX_YAW = 0.25  # Offset of the eye midpoint from the box center, as a fraction of its width
+MIN_BRIGHTNESS = 40
+MAX_BRIGHTNESS = 220
+
+
+def measure(face, facial_area):
+    """Return sharpness, size, roll, yaw and brightness of a BGR uint8 face crop
+
+    roll and yaw are None when the detector gave no eye landmarks.
+    """
+    gray = cv2.cvtColor(face, cv2.COLOR_BGR2GRAY)
+    metrics = {
+        "sharpness": cv2.Laplacian(gray, cv2.CV_64F).var(),
+        "size": min(facial_area["w"], facial_area["h"]),
+        "brightness": gray.mean(),
+        "roll": None,
+        "yaw": None,
+    }
+
+    # Pose from the eye landmarks, when the detector provides them
+    left_eye, right_eye = facial_area.get("left_eye"), facial_area.get("right_eye")
+    if left_eye and right_eye:
+        dx, dy = right_eye[0] - left_eye[0], right_eye[1] - left_eye[1]
+        metrics["roll"] = abs(math.degrees(math.atan2(dy, dx)))
+        metrics["roll"] = min(metrics["roll"], 180 - metrics["roll"])
+        center_x = facial_area["x"] + facial_area["w"] / 2
+        metrics["yaw"] = abs((left_eye[0] + right_eye[0]) / 2 - center_x) / facial_area["w"]
+    return metrics
+
+
+class QualityGate:
+    """Scores face crops before embedding and counts rejections per reason"""
+
+    def __init__(self):
+        self.rejections = Counter()
+        self.accepted = 0
+        self.pose_unchecked = 0  # Accepted without landmarks, so without a pose check
+
+    def score(self, face, facial_area, confidence=1.0):
+        """Return a score in [0, 1] for a face crop, or None if it should not be embedded"""
+        if not confidence:
+            self.rejections["no_face"] += 1
+            return None
+
+        metrics = measure(face, facial_area)
+        pose_known = metrics["roll"] is not None
+        if metrics["size"] < MIN_FACE_SIZE:
+            reason = "too_small"
+        elif metrics["sharpness"] < MIN_SHARPNESS:
+            reason = "blurry"
+        elif pose_known and (metrics["roll"] > MAX_ROLL or metrics["yaw"] > MAX_YAW):
+            reason = "pose"
+        elif not MIN_BRIGHTNESS <= metrics["brightness"] <= MAX_BRIGHTNESS:
+            reason = "brightness"
+        else:
+            reason = None
+
+        if reason:
+            self.rejections[reason] += 1
+            return None
+
+        self.accepted += 1
+        if pose_known:
+            pose = 1 - metrics["roll"] / MAX_ROLL / 2 - metrics["yaw"] / MAX_YAW / 2
+        else:
+            self.pose_unchecked += 1
+            pose = 0.5  # Neither rewarded nor penalized
+        # Each term is 1 for an ideal face and falls towards 0 near its threshold
+        return (
+            min(metrics["sharpness"] / (4 * MIN_SHARPNESS), 1)
+            + min(metrics["size"] / (3 * MIN_FACE_SIZE), 1)
+            + pose
+            + 1 - abs(metrics["brightness"] - 128) / 128
+        ) / 4
+
+
+def overlap(a, b):
+    """Intersection over union of two facial areas"""
+    x1, y1 = max(a["x"], b["x"]), max(a["y"], b["y"])
+    x2 = min(a["x"] + a["w"], b["x"] + b["w"])
+    y2 = min(a["y"] + a["h"], b["y"] + b["h"])
+    intersection = max(0, x2 - x1) * max(0, y2 - y1)
+    union = a["w"] * a["h"] + b["w"] * b["h"] - intersection
+    return intersection / union if union else 0
+
+
+class BurstSelector:
+    """Keeps only the best-scoring crop of each person over a short burst of frames
+
+    People are tracked across the burst by the overlap of their face boxes, so no
+    embedding is needed to tell them apart.
+    """
+
+    def __init__(self, gate, min_overlap=0.3):
+        self.gate = gate
+        self.min_overlap = min_overlap
+        self.tracks = []  # [score, face, last facial area]
+        self.candidates = 0
+
+    def add(self, face, facial_area, confidence=1.0):
+        """Score a detected face and keep it if it is the best of its track so far"""
+        score = self.gate.score(face, facial_area, confidence)
+        if score is None:
+            return
+        self.candidates += 1
+
+        for track in self.tracks:
+            if overlap(track[2], facial_area) >= self.min_overlap:
+                track[2] = facial_area
+                if score > track[0]:
+                    track[0], track[1] = score, face
+                return
+        self.tracks.append([score, face, facial_area])
+
+    def best(self):
+        """Return the best face crop of every person seen in the burst"""
+        return [face for _, face, _ in self.tracks]
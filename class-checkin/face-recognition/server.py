@@ -0,0 +1,216 @@
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+import cv2
+import numpy as np
+from embedding_cache import EmbeddingCache
+from gallery import DETECTOR_BACKEND, MODEL_NAME, Gallery, GalleryWatcher, detect_faces, embed_faces
+
+# Listen on TCP by default, or on a Unix socket when SERVER_SOCKET is set
+SERVER_HOST = os.getenv("SERVER_HOST", "127.0.0.1")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "8100"))
+SERVER_SOCKET = os.getenv("SERVER_SOCKET")
+# Requests are coalesced until the batch is full or the oldest one waited this long
+MAX_BATCH = int(os.getenv("MAX_BATCH", "8"))
+MAX_BATCH_WAIT_MS = float(os.getenv("MAX_BATCH_WAIT_MS", "20"))
+GALLERY_POLL_INTERVAL = float(os.getenv("GALLERY_POLL_INTERVAL", "2"))
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+
+
+class MicroBatcher:
+    """Coalesces concurrent recognition requests into batches for the embedding model"""
+
+    def __init__(self, gallery, max_batch=MAX_BATCH, max_wait_ms=MAX_BATCH_WAIT_MS):
+        self.gallery = gallery
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        # The only thread that runs the model: batches and gallery refreshes take turns on it
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batches = 0
+        self.requests = 0
+
+    async def submit(self, image, kind):
+        """Queue an encoded image ("frame" or "crop") and wait for its result"""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image, kind, time.perf_counter(), future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            self.batches += 1
+            self.requests += len(batch)
+            try:
+                results = await loop.run_in_executor(self.executor, self.process, batch)
+            except Exception as e:
+                results = [{"error": str(e)}] * len(batch)
+            for (_, _, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def process(self, batch):
+        """Decode and detect each request, then embed all of their faces together"""
+        started = time.perf_counter()
+        snapshot = self.gallery.snapshot
+        faces, owners, results = [], [], []
+        for index, (image, kind, queued, _) in enumerate(batch):
+            result = {"faces": [], "timing": {"queue_ms": (started - queued) * 1000}}
+            results.append(result)
+
+            step = time.perf_counter()
+            img = cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if img is None:
+                result["error"] = "Could not decode image"
+                continue
+            if kind == "crop":
+                # Crops are already aligned faces, so skip detection
+                height, width = img.shape[:2]
+                detected = [(img, {"x": 0, "y": 0, "w": width, "h": height}, 1.0)]
+            else:
+                try:
+                    detected = [face for face in detect_faces(img) if face[2]]
+                except Exception as e:
+                    # A bad image must not fail the other requests of the batch
+                    result["error"] = f"Face detection failed: {e}"
+                    continue
+            result["timing"]["detect_ms"] = (time.perf_counter() - step) * 1000
+
+            for face, facial_area, confidence in detected:
+                faces.append(face)
+                owners.append((index, facial_area, confidence))
+
+        step = time.perf_counter()
+        embeddings = embed_faces(faces)
+        embed_ms = (time.perf_counter() - step) * 1000
+
+        for embedding, (index, facial_area, confidence) in zip(embeddings, owners):
+            identity, distance = snapshot.match(embedding)
+            results[index]["faces"].append(
+                {
+                    "identity": identity,
+                    "distance": distance,
+                    "facial_area": {k: facial_area[k] for k in ("x", "y", "w", "h")},
+                    "confidence": confidence,
+                }
+            )
+
+        finished = time.perf_counter()
+        for result, (_, _, queued, _) in zip(results, batch):
+            result["timing"]["embed_ms"] = embed_ms
+            result["timing"]["batch_size"] = len(batch)
+            result["timing"]["batch_faces"] = len(faces)
+            result["timing"]["total_ms"] = (finished - queued) * 1000
+        return results
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0,
+            "queued": self.queue.qsize(),
+            "gallery_size": len(self.gallery.snapshot),
+        }
+
+
+async def read_request(reader):
+    """Parse a minimal HTTP/1.1 request, returning (method, path, query, body)"""
+    request_line = (await reader.readline()).decode("latin-1").strip()
+    if not request_line:
+        return None
+    method, target, _ = request_line.split(" ", 2)
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode("latin-1").strip()
+        if not line:
+            break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", "0")))
+    url = urlsplit(target)
+    return method, url.path, parse_qs(url.query), body
+
+
+def write_response(writer, status, payload):
+    body = json.dumps(payload).encode()
+    writer.write(
+        f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+        f"Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: close\r\n\r\n".encode()
+        + body
+    )
+
+
+def make_handler(batcher):
+    async def handle(reader, writer):
+        try:
+            request = await read_request(reader)
+            if request is None:
+                return
+            method, path, query, body = request
+            if method == "POST" and path == "/recognize":
+                # ?kind=crop for aligned face crops, anything else is a full frame
+                kind = query.get("kind", ["frame"])[0]
+                if not body:
+                    write_response(writer, 400, {"error": "Empty image"})
+                else:
+                    write_response(writer, 200, await batcher.submit(body, kind))
+            elif method == "GET" and path == "/stats":
+                write_response(writer, 200, batcher.stats())
+            else:
+                write_response(writer, 404, {"error": f"No route for {method} {path}"})
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            write_response(writer, 400, {"error": f"Malformed request: {e}"})
+        except Exception as e:
+            print(f"Error handling request: {e}")
+            write_response(writer, 500, {"error": str(e)})
+        finally:
+            await writer.drain()
+            writer.close()
+
+    return handle
+
+
+async def serve():
+    gallery = Gallery(cache=EmbeddingCache(MODEL_NAME, DETECTOR_BACKEND)).load()
+    batcher = MicroBatcher(gallery)
+    # Enrollment embeds on the batch executor, so it never runs the model concurrently
+    GalleryWatcher(gallery, GALLERY_POLL_INTERVAL, batcher.executor).start()
+    # Load the detector and model before accepting requests so the first batch is not slow
+    blank = cv2.imencode(".jpg", np.zeros((112, 112, 3), np.uint8))[1].tobytes()
+    batcher.process([(blank, kind, time.perf_counter(), None) for kind in ("frame", "crop")])
+    batch_task = asyncio.create_task(batcher.run())
+
+    if SERVER_SOCKET:
+        server = await asyncio.start_unix_server(make_handler(batcher), path=SERVER_SOCKET)
+        print(f"Recognition server listening on {SERVER_SOCKET}")
+    else:
+        server = await asyncio.start_server(make_handler(batcher), SERVER_HOST, SERVER_PORT)
+        print(f"Recognition server listening on http://{SERVER_HOST}:{SERVER_PORT}")
+    print(f"Micro-batching up to {MAX_BATCH} requests or {MAX_BATCH_WAIT_MS} ms")
+
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        print("Keyboard interrupt detected. Shutting down...")
@@ -1,4 +1,9 @@
+import queue
+import statistics
 import sys
+import threading
+import time
+from collections import deque
 import paho.mqtt.client as mqtt
 
 import os
@@ -13,60 +18,255 @@ USERNAME = os.getenv("USERNAME")
 PASSWORD = os.getenv("PASSWORD")
 BROKER_AUTH = int(os.getenv("BROKER_AUTH", "1")) == 1
 TOPIC_PREFIX = os.getenv("TOPIC_PREFIX")
+# Delivery: 0 fires and forgets, 1 waits for the broker's acknowledgement (PUBACK)
+PUBLISH_QOS = int(os.getenv("PUBLISH_QOS", "0"))
+PUBLISH_QUEUE_SIZE = int(os.getenv("PUBLISH_QUEUE_SIZE", "1000"))
+LATENCY_WINDOW = 1000  # Recent publish-to-ack latencies kept for the stats
 
 # Available system states
 STATES = ["IDLE", "SCANNING", "SUCCESS", "FAILURE", "ALREADY_SCANNED", "ERROR"]
 
-# Global MQTT client
-client = None
 
+class Publisher:
+    """One MQTT connection shared by every room, with publishes queued to a sender thread
+
+    publish() only enqueues, so callers never block on the network. The sender waits
+    out disconnections while paho reconnects in the background, and tracks each
+    message until the broker acknowledges it (QoS 1) or it is written out (QoS 0).
+    """
+
+    def __init__(self, broker=BROKER, port=1883, qos=PUBLISH_QOS, queue_size=PUBLISH_QUEUE_SIZE):
+        self.broker = broker
+        self.port = port
+        self.qos = qos
+        try:
+            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)  # For newer versions
+        except AttributeError:
+            self.client = mqtt.Client()
+        if BROKER_AUTH:
+            self.client.username_pw_set(USERNAME, PASSWORD)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_publish = self.on_publish
+
+        self.queue = queue.Queue(queue_size)
+        self.connected = threading.Event()
+        self.lock = threading.Lock()
+        self.in_flight = {}  # mid -> (qos, time sent)
+        self.early_acks = {}  # mid -> ack time, for acks recorded before the sender saw the mid
+        self.ack_latencies = deque(maxlen=LATENCY_WINDOW)  # QoS 1: publish to PUBACK
+        self.write_latencies = deque(maxlen=LATENCY_WINDOW)  # QoS 0: publish to socket write
+        self.counts = {"queued": 0, "sent": 0, "acked": 0, "dropped": 0, "lost": 0}
+        self.thread = None
+
+    def start(self):
+        """Connect in the background and start the sender thread"""
+        if self.thread is not None:
+            return
+        # Unlike connect(), connect_async keeps retrying while the broker is unreachable
+        self.client.connect_async(self.broker, self.port, 60)
+        self.client.loop_start()
+        self.thread = threading.Thread(target=self.run, name="mqtt-publisher", daemon=True)
+        self.thread.start()
+
+    def wait_connected(self, timeout=None):
+        return self.connected.wait(timeout)
+
+    def room(self, prefix):
+        """Device commands for one room's topic prefix, over this connection"""
+        return Room(self, prefix)
+
+    def publish(self, topic, payload, qos=None):
+        """Queue a message; returns False if the queue is full and it was dropped"""
+        try:
+            self.queue.put_nowait((topic, payload, self.qos if qos is None else qos))
+        except queue.Full:
+            with self.lock:
+                self.counts["dropped"] += 1
+            print(f"Publish queue full, dropped: {topic} -> {payload}")
+            return False
+        with self.lock:
+            self.counts["queued"] += 1
+        return True
 
-def initialize():
-    """Initialize the MQTT client connection"""
-    global client
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            topic, payload, qos = item
+            info = None
+            while True:
+                # paho would discard a QoS 0 message published while disconnected
+                while not self.connected.wait(1.0):
+                    pass
+                if self.thread is None and not self.client.is_connected():
+                    # stop() gave up waiting for the connection
+                    break
+                # Publish outside self.lock: paho calls on_publish while holding its own
+                # message lock, so taking both here would deadlock with its network thread
+                sent_at = time.perf_counter()
+                info = self.client.publish(topic, payload, qos)
+                if info.rc != mqtt.MQTT_ERR_NO_CONN or qos != 0:
+                    break
+                # paho dropped it; retry this message, keeping the order, once on_disconnect
+                # has run (clearing `connected` here could miss a reconnect in between)
+                time.sleep(0.1)
+            if info is None:
+                print(f"Not connected, dropped: {topic} -> {payload}")
+                with self.lock:
+                    self.counts["lost"] += 1
+            elif info.rc in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+                # A QoS 1 message that hit a dropped connection stays queued in paho,
+                # which sends it after reconnecting, so it is tracked like a sent one
+                with self.lock:
+                    self.counts["sent"] += 1
+                    acked_at = self.early_acks.pop(info.mid, None)
+                    if acked_at is not None:
+                        self.record_ack(qos, sent_at, acked_at)
+                    else:
+                        self.in_flight[info.mid] = (qos, sent_at)
+            else:
+                print(f"Failed to publish {topic} -> {payload}: {mqtt.error_string(info.rc)}")
+            self.queue.task_done()
+
+    def record_ack(self, qos, sent_at, acked_at):
+        # QoS 0 "acks" only mean the message was written to the socket
+        self.counts["acked"] += 1
+        latencies = self.write_latencies if qos == 0 else self.ack_latencies
+        latencies.append(acked_at - sent_at)
+
+    def on_connect(self, client, userdata, flags, rc, *args):
+        if rc == 0:
+            print(f"Connected to MQTT broker at {self.broker}")
+            self.connected.set()
+        else:
+            print(f"Failed to connect to MQTT broker: {rc}")
+
+    def on_disconnect(self, client, userdata, *args):
+        self.connected.clear()
+        with self.lock:
+            # paho resends unacknowledged QoS 1 messages after reconnecting, but discards
+            # QoS 0 packets still waiting in its output buffer without calling on_publish
+            for mid in [mid for mid, (qos, _) in self.in_flight.items() if qos == 0]:
+                del self.in_flight[mid]
+                self.counts["lost"] += 1
+        if self.thread is not None:
+            print("Disconnected from MQTT broker, reconnecting")
+
+    def on_publish(self, client, userdata, mid, *args):
+        acked_at = time.perf_counter()
+        with self.lock:
+            entry = self.in_flight.pop(mid, None)
+            if entry is None:
+                self.early_acks[mid] = acked_at
+            else:
+                self.record_ack(entry[0], entry[1], acked_at)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts, pending=self.queue.qsize(), in_flight=len(self.in_flight))
+            windows = {"ack_latency_ms": self.ack_latencies, "write_latency_ms": self.write_latencies}
+            windows = {name: sorted(latencies) for name, latencies in windows.items()}
+        for name, latencies in windows.items():
+            if latencies:
+                stats[name] = {
+                    "p50": statistics.median(latencies) * 1000,
+                    "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+                    "max": latencies[-1] * 1000,
+                }
+        return stats
+
+    def flush(self, timeout=5.0):
+        """Wait until everything queued has been delivered; False on timeout"""
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks or self.in_flight:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
 
-    try:
-        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)  # For newer versions
-    except AttributeError:
-        client = mqtt.Client()
+    def stop(self, timeout=5.0):
+        """Deliver what is queued (for up to timeout seconds), then disconnect"""
+        if self.thread is None:
+            return
+        if not self.flush(timeout):
+            print(f"Disconnecting with undelivered messages: {self.stats()}")
+        thread, self.thread = self.thread, None
+        self.queue.put(None)
+        # Let a sender stuck waiting for the connection exit too
+        self.connected.set()
+        thread.join(timeout)
+        self.client.disconnect()
+        self.client.loop_stop()
+        self.connected.clear()
+
+
+class Room:
+    """Device commands for the Pi of one classroom, identified by its topic prefix"""
+
+    def __init__(self, publisher, prefix):
+        self.publisher = publisher
+        self.prefix = prefix
+
+    def send_command(self, device, command, params=None, qos=None):
+        """Send a command to control a device on the subscriber"""
+        topic = self.prefix + device
+        payload = command
+        if params:
+            payload += ":" + str(params)
+
+        print(f"Sent: {topic} -> {payload}")
+        return self.publisher.publish(topic, payload, qos)
+
+    def set_state(self, state_name):
+        """Set the system state"""
+        if state_name.upper() not in STATES:
+            print(f"Invalid state: {state_name}")
+            print(f"Available states: {', '.join(STATES)}")
+            return False
+
+        self.send_command("state", state_name.upper())
+        return True
 
-    if BROKER_AUTH:
-        client.username_pw_set(USERNAME, PASSWORD)
+    def reset_error(self):
+        """Send a reset command to clear the error state"""
+        self.send_command("reset", "")
+
+
+# Shared publisher and the room for TOPIC_PREFIX, created on first use
+publisher = None
+room = None
 
-    # Connect to the broker
-    try:
-        client.connect(BROKER, 1883, 60)
-        client.loop_start()
-        print(f"Connected to MQTT broker at {BROKER}")
-        return True
-    except Exception as e:
-        print(f"Failed to connect to MQTT broker: {e}")
-        return False
+
+def initialize(timeout=10.0):
+    """Start the shared publisher; returns True once it is connected to the broker"""
+    global publisher, room
+
+    if publisher is None:
+        publisher = Publisher()
+        room = publisher.room(TOPIC_PREFIX)
+        publisher.start()
+    return publisher.wait_connected(timeout)
+
+
+def get_room(prefix=None):
+    """Room for a topic prefix (TOPIC_PREFIX by default) on the shared connection"""
+    if publisher is None:
+        initialize(timeout=0)
+    return room if prefix is None else publisher.room(prefix)
 
 
 def send_command(device, command, params=None):
     """Send a command to control a device on the subscriber"""
-    topic = TOPIC_PREFIX + device
-    payload = command
-    if params:
-        payload += ":" + str(params)
-
-    print(f"Sent: {topic} -> {payload}")
-    # Actually send the message
-    client.publish(topic, payload)
+    return get_room().send_command(device, command, params)
 
 
 def set_state(state_name):
     """Set the system state"""
-    # Import inside function to avoid circular import
-
-    if state_name.upper() not in STATES:
-        print(f"Invalid state: {state_name}")
-        print(f"Available states: {', '.join(STATES)}")
-        return False
-
-    send_command("state", state_name.upper())
-    return True
+    return get_room().set_state(state_name)
 
 
 # Convenience functions for each state
@@ -91,7 +291,8 @@ def set_already_scanned():
 
 
 def disconnect():
-    client.disconnect()
+    if publisher is not None:
+        publisher.stop()
 
 
 def set_error():
@@ -100,9 +301,7 @@ def set_error():
 
 def reset_error():
     """Send a reset command to clear the error state"""
-    # Import inside function to avoid circular import
-
-    send_command("reset", "")
+    get_room().reset_error()
 
 
 def run_state_menu():
@@ -113,12 +312,16 @@ def run_state_menu():
     for i, state in enumerate(STATES, 1):
         print(f"{i}. {state}")
 
+    print("S. Show publisher stats")
     print("R. Return to main menu")
 
     choice = input("Select state or action: ").strip().upper()
 
     if choice == "R":
         return
+    if choice == "S":
+        print(publisher.stats())
+        return
 
     try:
         state_index = int(choice) - 1
@@ -128,18 +331,15 @@ def run_state_menu():
         else:
             print("Invalid selection")
     except ValueError:
-        print("Please enter a number or 'R'")
+        print("Please enter a number, 'S' or 'R'")
 
 
 if __name__ == "__main__":
     # This allows the state controller to be run directly
     if not initialize():
+        print(f"Failed to connect to MQTT broker at {BROKER}")
         sys.exit(1)
 
     run_state_menu()
     # Clean up
-    client.loop_stop()
-    client.disconnect()
-else:
-    # When imported as a module, initialize the connection
-    initialize()
+    disconnect()